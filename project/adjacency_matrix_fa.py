@@ -1,13 +1,34 @@
 import numpy as np
 
-from typing import Dict, Iterable
+from collections import defaultdict
+from typing import Dict, Iterable, Set
 from pyformlang.finite_automaton import NondeterministicFiniteAutomaton, State, Symbol
-from scipy.sparse import csc_matrix, eye, kron, csr_matrix
-from project.finite_automata_lib import graph_to_nfa, regex_to_dfa
+from scipy.sparse import kron, csr_matrix
+from project.finite_automata_lib import regex_to_dfa
+from project.graph_lib import GraphMatrices, graph_to_matrices
+from project.transitive_closure import transitive_closure
 from networkx import MultiDiGraph
 from pyformlang.rsa.recursive_automaton import RecursiveAutomaton
 
 
+def bool_matrix_from_indices(
+    rows: Iterable[int], cols: Iterable[int], size: int
+) -> csr_matrix:
+    rows = np.asarray(rows, dtype=np.int64)
+    cols = np.asarray(cols, dtype=np.int64)
+    return csr_matrix(
+        (np.ones(len(rows), dtype=bool), (rows, cols)),
+        shape=(size, size),
+        dtype=bool,
+    )
+
+
+def _rows_selector(rows: list[int], size: int) -> csr_matrix:
+    return csr_matrix(
+        (np.ones(len(rows), dtype=bool), (rows, rows)), shape=(size, size), dtype=bool
+    )
+
+
 class AdjacencyMatrixFA:
     def __init__(
         self, nfa: NondeterministicFiniteAutomaton | RecursiveAutomaton
@@ -38,69 +59,194 @@ class AdjacencyMatrixFA:
 
         self.bool_decomposition = self.build_bool_decomposition(nfa)
 
+    @classmethod
+    def from_matrices(cls, graph_matrices: GraphMatrices) -> "AdjacencyMatrixFA":
+        adjacency_matrix_fa = cls(None)
+
+        adjacency_matrix_fa.states_count = len(graph_matrices.nodes)
+        adjacency_matrix_fa.id_state = dict(enumerate(graph_matrices.nodes))
+        adjacency_matrix_fa.state_id = {
+            node: index for index, node in adjacency_matrix_fa.id_state.items()
+        }
+
+        adjacency_matrix_fa.start_states_id = set(graph_matrices.start_nodes_id)
+        adjacency_matrix_fa.final_states_id = set(graph_matrices.final_nodes_id)
+        adjacency_matrix_fa.start_states = {
+            adjacency_matrix_fa.id_state[i] for i in graph_matrices.start_nodes_id
+        }
+        adjacency_matrix_fa.final_states = {
+            adjacency_matrix_fa.id_state[i] for i in graph_matrices.final_nodes_id
+        }
+
+        adjacency_matrix_fa.bool_decomposition = dict(graph_matrices.bool_decomposition)
+        return adjacency_matrix_fa
+
+    @classmethod
+    def from_graph(
+        cls, graph: MultiDiGraph, start_nodes: Set[int], final_nodes: Set[int]
+    ) -> "AdjacencyMatrixFA":
+        return cls.from_matrices(graph_to_matrices(graph, start_nodes, final_nodes))
+
     def build_bool_decomposition(
         self, nfa: NondeterministicFiniteAutomaton
     ) -> Dict[Symbol, csr_matrix]:
-        bool_decomposition = {}
+        transitions = defaultdict(lambda: ([], []))
         for fst_state, symbol_snd_states in nfa.to_dict().items():
             for symbol, next_states in symbol_snd_states.items():
                 next_states = (
                     {next_states} if not isinstance(next_states, set) else next_states
                 )
 
+                rows, cols = transitions[symbol]
                 for next_state in next_states:
-                    if symbol not in bool_decomposition:
-                        bool_decomposition[symbol] = csr_matrix(
-                            (self.states_count, self.states_count), dtype=bool
-                        )
-                    bool_decomposition[symbol][
-                        self.state_id[fst_state], self.state_id[next_state]
-                    ] = True
+                    rows.append(self.state_id[fst_state])
+                    cols.append(self.state_id[next_state])
+
+        return {
+            symbol: bool_matrix_from_indices(rows, cols, self.states_count)
+            for symbol, (rows, cols) in transitions.items()
+        }
 
-        return bool_decomposition
+    def _states_vector(self, states_id: Iterable[int], rows: int = 1) -> csr_matrix:
+        states_id = np.fromiter(states_id, dtype=np.int64)
+        return csr_matrix(
+            (
+                np.ones(rows * len(states_id), dtype=bool),
+                (np.repeat(np.arange(rows), len(states_id)), np.tile(states_id, rows)),
+            ),
+            shape=(rows, self.states_count),
+            dtype=bool,
+        )
 
     def accepts(self, word: Iterable[Symbol]) -> bool:
-        current_states = set(self.start_states_id)
+        frontier = self._states_vector(self.start_states_id)
 
         for symbol in word:
-            next_states = set()
-            if symbol in self.bool_decomposition:
-                transition_matrix = self.bool_decomposition[symbol]
-                for current_state in current_states:
-                    next_states.update(
-                        next_state
-                        for next_state in range(self.states_count)
-                        if transition_matrix[current_state, next_state]
+            if symbol not in self.bool_decomposition:
+                return False
+            frontier = frontier @ self.bool_decomposition[symbol]
+            if frontier.nnz == 0:
+                return False
+
+        return not self.final_states_id.isdisjoint(frontier.indices.tolist())
+
+    def accepts_many(self, words: Iterable[Iterable[Symbol]]) -> list[bool]:
+        words = [list(word) for word in words]
+        # Row i of the frontier holds the current states for words[i]
+        frontier = self._states_vector(self.start_states_id, len(words))
+
+        for position in range(max(map(len, words), default=0)):
+            rows_by_symbol = defaultdict(list)
+            finished_rows = []
+            for row, word in enumerate(words):
+                if position < len(word):
+                    rows_by_symbol[word[position]].append(row)
+                else:
+                    finished_rows.append(row)
+
+            new_frontier = _rows_selector(finished_rows, len(words)) @ frontier
+            for symbol, rows in rows_by_symbol.items():
+                if symbol in self.bool_decomposition:
+                    new_frontier += (
+                        _rows_selector(rows, len(words))
+                        @ frontier
+                        @ self.bool_decomposition[symbol]
                     )
+            frontier = new_frontier
 
-            current_states = next_states
-        return bool(self.final_states_id & current_states)
+        accepted = frontier @ self._states_vector(self.final_states_id).T
+        return [bool(is_accepted) for is_accepted in accepted.toarray().ravel()]
 
-    def is_empty(self) -> bool:
-        transitive_closure = self.get_transitive_closure()
-        for start_state_id in self.start_states_id:
-            for final_state_id in self.final_states_id:
-                if transitive_closure[start_state_id, final_state_id]:
-                    return False
-        return True
+    def is_empty(self, bidirectional: bool = False) -> bool:
+        if len(self.start_states_id) == 0 or len(self.final_states_id) == 0:
+            return True
 
-    def get_transitive_closure(self) -> csc_matrix:
-        identity_matrix = eye(self.states_count, dtype=bool)
-        adjacency_matrix = csc_matrix(identity_matrix)
+        adjacency_matrix = self.get_adjacency_matrix()
+        if bidirectional:
+            return not _frontiers_meet(
+                adjacency_matrix, self.start_states_id, self.final_states_id
+            )
+        return not _reaches(
+            adjacency_matrix, self.start_states_id, self.final_states_id
+        )
+
+    def get_adjacency_matrix(self) -> csr_matrix:
+        adjacency_matrix = csr_matrix(
+            (self.states_count, self.states_count), dtype=bool
+        )
 
         for symbol in self.bool_decomposition:
             adjacency_matrix += self.bool_decomposition[symbol]
 
-        current_power = adjacency_matrix
-        exponent = self.states_count
+        return csr_matrix(adjacency_matrix)
+
+    def get_transitive_closure(self, strategy: str = "auto") -> csr_matrix:
+        return transitive_closure(self.get_adjacency_matrix(), strategy)
+
+
+def _states_mask(states_id: Iterable[int], states_count: int) -> np.ndarray:
+    mask = np.zeros(states_count, dtype=bool)
+    mask[list(states_id)] = True
+    return mask
+
+
+def _expand_frontier(
+    adjacency_matrix: csr_matrix, frontier: np.ndarray, visited: np.ndarray
+) -> np.ndarray:
+    next_states = np.unique(adjacency_matrix[frontier].indices)
+    next_states = next_states[~visited[next_states]]
+    visited[next_states] = True
+    return next_states
+
+
+def _reaches(
+    adjacency_matrix: csr_matrix, from_states: Set[int], to_states: Set[int]
+) -> bool:
+    states_count = adjacency_matrix.shape[0]
+    is_target = _states_mask(to_states, states_count)
+    visited = _states_mask(from_states, states_count)
+    frontier = np.flatnonzero(visited)
+
+    while len(frontier) != 0:
+        if is_target[frontier].any():
+            return True
+        frontier = _expand_frontier(adjacency_matrix, frontier, visited)
+    return False
+
+
+def _frontiers_meet(
+    adjacency_matrix: csr_matrix, from_states: Set[int], to_states: Set[int]
+) -> bool:
+    states_count = adjacency_matrix.shape[0]
+    reversed_adjacency_matrix = csr_matrix(adjacency_matrix.T)
+
+    forward_visited = _states_mask(from_states, states_count)
+    backward_visited = _states_mask(to_states, states_count)
+    forward_frontier = np.flatnonzero(forward_visited)
+    backward_frontier = np.flatnonzero(backward_visited)
+
+    if backward_visited[forward_frontier].any():
+        return True
+
+    while len(forward_frontier) != 0 and len(backward_frontier) != 0:
+        # Grow the smaller side, it is the cheaper one to expand
+        if len(forward_frontier) <= len(backward_frontier):
+            forward_frontier = _expand_frontier(
+                adjacency_matrix, forward_frontier, forward_visited
+            )
+            if backward_visited[forward_frontier].any():
+                return True
+        else:
+            backward_frontier = _expand_frontier(
+                reversed_adjacency_matrix, backward_frontier, backward_visited
+            )
+            if forward_visited[backward_frontier].any():
+                return True
+    return False
 
-        while exponent != 0:
-            if exponent % 2 == 1:
-                closure_matrix = np.dot(adjacency_matrix, current_power)
-            current_power = np.dot(current_power, current_power)
-            exponent //= 2
 
-        return closure_matrix
+def _state_value(state: State | object) -> object:
+    return state.value if isinstance(state, State) else state
 
 
 def intersect_automata(
@@ -122,7 +268,7 @@ def intersect_automata(
     for first_state, first_state_id in automaton1.state_id.items():
         for second_state, second_state_id in automaton2.state_id.items():
             new_state_id = first_state_id * automaton2.states_count + second_state_id
-            state = State((first_state.value, second_state.value))
+            state = State((_state_value(first_state), _state_value(second_state)))
             intersection.state_id[state] = new_state_id
             if (
                 first_state in automaton1.start_states
@@ -142,31 +288,146 @@ def intersect_automata(
     return intersection
 
 
-def tensor_based_rpq(
-    regex: str, graph: MultiDiGraph, start_nodes: set[int], final_nodes: set[int]
-) -> set[tuple[int, int]]:
-    nfa_of_graph = AdjacencyMatrixFA(graph_to_nfa(graph, start_nodes, final_nodes))
-    dfa_of_regex = AdjacencyMatrixFA(regex_to_dfa(regex))
+def _csr_successors(
+    matrix: csr_matrix, states: np.ndarray
+) -> tuple[np.ndarray, np.ndarray]:
+    # For every edge leaving states: the position of its source in states and its target
+    starts = matrix.indptr[states]
+    counts = matrix.indptr[states + 1] - starts
+    positions = np.repeat(np.arange(len(states)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return positions, matrix.indices[np.repeat(starts, counts) + offsets]
 
-    intersection = intersect_automata(nfa_of_graph, dfa_of_regex)
-    transitive_closure = intersection.get_transitive_closure()
+
+def _lazy_product_rpq(
+    graph_fa: AdjacencyMatrixFA, regex_fa: AdjacencyMatrixFA
+) -> set[tuple[int, int]]:
+    # Product state (graph state g, regex state q) is encoded as g * k + q
+    k = regex_fa.states_count
+    transitions = [
+        (csr_matrix(graph_fa.bool_decomposition[symbol]), csr_matrix(regex_matrix))
+        for symbol, regex_matrix in regex_fa.bool_decomposition.items()
+        if symbol in graph_fa.bool_decomposition
+    ]
+    regex_start_states = np.array(sorted(regex_fa.start_states_id), dtype=np.int64)
+    is_regex_final = _states_mask(regex_fa.final_states_id, k)
+    is_graph_final = _states_mask(graph_fa.final_states_id, graph_fa.states_count)
+    visited = np.zeros(graph_fa.states_count * k, dtype=bool)
 
     result = set()
+    for start_state_id in graph_fa.start_states_id:
+        frontier = start_state_id * k + regex_start_states
+        visited[frontier] = True
+        reached = [frontier]
 
-    for start in start_nodes:
-        for final in final_nodes:
-            for dfa_start_state in dfa_of_regex.start_states:
-                for dfa_final_state in dfa_of_regex.final_states:
-                    intersection_start_id = intersection.state_id[
-                        (start, dfa_start_state)
-                    ]
-                    intersection_final_id = intersection.state_id[
-                        (final, dfa_final_state)
-                    ]
-                    if transitive_closure[
-                        intersection_start_id,
-                        intersection_final_id,
-                    ]:
-                        result.add((start, final))
+        while len(frontier) != 0:
+            graph_states, regex_states = np.divmod(frontier, k)
+            successors = [np.empty(0, dtype=np.int64)]
+            for graph_matrix, regex_matrix in transitions:
+                regex_positions, next_regex_states = _csr_successors(
+                    regex_matrix, regex_states
+                )
+                graph_positions, next_graph_states = _csr_successors(
+                    graph_matrix, graph_states[regex_positions]
+                )
+                successors.append(
+                    next_graph_states * k + next_regex_states[graph_positions]
+                )
+
+            frontier = np.unique(np.concatenate(successors))
+            frontier = frontier[~visited[frontier]]
+            visited[frontier] = True
+            reached.append(frontier)
+
+        reached = np.concatenate(reached)
+        visited[reached] = False
+
+        graph_states, regex_states = np.divmod(reached, k)
+        final_graph_states = graph_states[
+            is_regex_final[regex_states] & is_graph_final[graph_states]
+        ]
+        result.update(
+            (graph_fa.id_state[start_state_id], graph_fa.id_state[final_state_id])
+            for final_state_id in np.unique(final_graph_states).tolist()
+        )
 
     return result
+
+
+def _tensor_rpq_matrix(
+    graph_fa: AdjacencyMatrixFA, regex_fa: AdjacencyMatrixFA
+) -> csr_matrix:
+    intersection = intersect_automata(graph_fa, regex_fa)
+    transitive_closure = intersection.get_transitive_closure()
+
+    # Intersection state of (graph state g, regex state q) has index g * k + q
+    k = regex_fa.states_count
+    graph_starts = np.array(sorted(graph_fa.start_states_id), dtype=np.int64)
+    graph_finals = np.array(sorted(graph_fa.final_states_id), dtype=np.int64)
+    regex_starts = np.array(sorted(regex_fa.start_states_id), dtype=np.int64)
+    regex_finals = np.array(sorted(regex_fa.final_states_id), dtype=np.int64)
+
+    rows = (graph_starts[:, np.newaxis] * k + regex_starts).ravel()
+    cols = (graph_finals[:, np.newaxis] * k + regex_finals).ravel()
+    reachable = transitive_closure[rows][:, cols].tocoo()
+
+    return csr_matrix(
+        (
+            np.ones(reachable.nnz, dtype=bool),
+            (
+                graph_starts[reachable.row // max(len(regex_starts), 1)],
+                graph_finals[reachable.col // max(len(regex_finals), 1)],
+            ),
+        ),
+        shape=(graph_fa.states_count, graph_fa.states_count),
+        dtype=bool,
+    )
+
+
+def tensor_based_rpq_matrix(
+    regex: str, graph: MultiDiGraph, start_nodes: set[int], final_nodes: set[int]
+) -> csr_matrix:
+    # Rows and columns follow the order of graph.nodes
+    if not start_nodes or not final_nodes:
+        nodes_count = graph.number_of_nodes()
+        return csr_matrix((nodes_count, nodes_count), dtype=bool)
+
+    return _tensor_rpq_matrix(
+        AdjacencyMatrixFA.from_graph(graph, start_nodes, final_nodes),
+        AdjacencyMatrixFA(regex_to_dfa(regex)),
+    )
+
+
+def tensor_based_rpq_pairs(
+    regex: str, graph: MultiDiGraph, start_nodes: set[int], final_nodes: set[int]
+) -> np.ndarray:
+    result_matrix = tensor_based_rpq_matrix(regex, graph, start_nodes, final_nodes)
+    nodes = np.asarray(list(graph.nodes))
+    rows, cols = result_matrix.nonzero()
+    return np.column_stack((nodes[rows], nodes[cols]))
+
+
+def tensor_based_rpq(
+    regex: str,
+    graph: MultiDiGraph,
+    start_nodes: set[int],
+    final_nodes: set[int],
+    lazy: bool = False,
+) -> set[tuple[int, int]]:
+    # As in the matrix and pairs variants, empty start or final nodes do not
+    # stand for all nodes here
+    if not start_nodes or not final_nodes:
+        return set()
+
+    nfa_of_graph = AdjacencyMatrixFA.from_graph(graph, start_nodes, final_nodes)
+    dfa_of_regex = AdjacencyMatrixFA(regex_to_dfa(regex))
+
+    if lazy:
+        # Explore only the part of the product reachable from the start pairs
+        return _lazy_product_rpq(nfa_of_graph, dfa_of_regex)
+
+    result_matrix = _tensor_rpq_matrix(nfa_of_graph, dfa_of_regex)
+    return {
+        (nfa_of_graph.id_state[start_id], nfa_of_graph.id_state[final_id])
+        for start_id, final_id in zip(*result_matrix.nonzero())
+    }
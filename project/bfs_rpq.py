@@ -1,59 +1,86 @@
+import numpy as np
+
 from scipy.sparse import (
     csr_matrix,
-    vstack,
+    eye,
+    kron,
 )
-from project.finite_automata_lib import regex_to_dfa, graph_to_nfa
+from project.finite_automata_lib import regex_to_dfa
 from networkx import MultiDiGraph
 from project.adjacency_matrix_fa import AdjacencyMatrixFA
-from typing import Set
-from pyformlang.finite_automaton import State
+from typing import Iterable
+from concurrent.futures import ProcessPoolExecutor
 
 
 def init_frontier(reg_mat, graph_mat, start_states_id) -> csr_matrix:
-    n = graph_mat.states_count
+    # One block of reg_mat.states_count rows per start vertex, in the given order
+    start_states_id = np.fromiter(start_states_id, dtype=np.int64)
+    reg_start_states_id = np.array(sorted(reg_mat.start_states_id), dtype=np.int64)
     k = reg_mat.states_count
-    frontier_row = csr_matrix((1, n), dtype=bool)
 
-    for i in start_states_id:
-        frontier_row[0, i] = True
-    frontier = csr_matrix((k, n), dtype=bool)
+    rows = np.arange(len(start_states_id))[:, np.newaxis] * k + reg_start_states_id
+    cols = np.repeat(start_states_id, len(reg_start_states_id))
+    return csr_matrix(
+        (np.ones(rows.size, dtype=bool), (rows.ravel(), cols)),
+        shape=(len(start_states_id) * k, graph_mat.states_count),
+        dtype=bool,
+    )
 
-    for i in reg_mat.start_states_id:
-        frontier[i, :] = frontier_row
-    return frontier
 
+# The frontier, its product with a label matrix, the new frontier and the
+# visited matrix all have the shape of one chunk's frontier
+_FRONTIER_MATRICES_COUNT = 4
+_CSR_ENTRY_SIZE = np.dtype(bool).itemsize + np.dtype(np.int64).itemsize
 
-def multiple_source_bfs(graph_mat, reg_mat) -> set[tuple[int, int]]:
-    if len(graph_mat.start_states_id) == 0:
-        return set()
+_worker_matrices = None
+
+
+def frontier_memory_bound(graph_mat, reg_mat, chunk_size: int) -> int:
+    rows = chunk_size * reg_mat.states_count
+    matrix_size = (
+        rows * graph_mat.states_count * _CSR_ENTRY_SIZE
+        + (rows + 1) * np.dtype(np.int64).itemsize
+    )
+    return _FRONTIER_MATRICES_COUNT * matrix_size
+
+
+def chunk_size_for_memory(graph_mat, reg_mat, memory_limit: int) -> int:
+    single_start_bound = frontier_memory_bound(graph_mat, reg_mat, 1)
+    if single_start_bound > memory_limit:
+        raise ValueError(
+            f"Memory limit {memory_limit} is below {single_start_bound}, "
+            "the frontier bound of a single start node"
+        )
+    return memory_limit // max(single_start_bound, 1)
 
+
+def _bfs_chunk(graph_mat, reg_mat, start_states_id: list[int]) -> set[tuple[int, int]]:
     new_symbols = (
         graph_mat.bool_decomposition.keys() & reg_mat.bool_decomposition.keys()
     )
 
     """ MS BFS"""
-    frontier = vstack(
-        [
-            init_frontier(reg_mat, graph_mat, {start_vertex})
-            for start_vertex in graph_mat.start_states_id
-        ]
-    )
+    frontier = init_frontier(reg_mat, graph_mat, start_states_id)
     is_visited = frontier
 
+    # Frontier rows are grouped in blocks of reg_mat.states_count rows, one block
+    # per start vertex, so a regex step is the block-diagonal operator I ⊗ R^T
+    block_transitions = {
+        symbol: kron(
+            eye(len(start_states_id), dtype=bool),
+            reg_mat.bool_decomposition[symbol].T,
+            format="csr",
+        )
+        for symbol in new_symbols
+    }
+
     while True:
         new_frontier = csr_matrix(frontier.shape, dtype=bool)
 
         for symbol in new_symbols:
-            new_frontier_component = frontier.dot(graph_mat.bool_decomposition[symbol])
-
-            for start_start_id in range(len(graph_mat.start_states_id)):
-                coressponding_frontier_position = start_start_id * reg_mat.states_count
-                rows, cols = reg_mat.bool_decomposition[symbol].nonzero()
-
-                for row, col in zip(rows, cols):
-                    new_frontier[coressponding_frontier_position + col, :] += (
-                        new_frontier_component[coressponding_frontier_position + row, :]
-                    )
+            new_frontier += block_transitions[symbol] @ (
+                frontier @ graph_mat.bool_decomposition[symbol]
+            )
 
         frontier = new_frontier > is_visited
 
@@ -62,34 +89,110 @@ def multiple_source_bfs(graph_mat, reg_mat) -> set[tuple[int, int]]:
 
         is_visited += frontier
 
-    def reachable_vertices(start_node_id: int) -> Set[State]:
-        coressponding_frontier_position = start_node_id * reg_mat.states_count
-        reachable_states = csr_matrix((1, graph_mat.states_count), dtype=bool)
+    # Merge the rows of final regex states in every block, keep final graph vertices
+    reg_final_states_id = sorted(reg_mat.final_states_id)
+    final_rows = kron(
+        eye(len(start_states_id), dtype=bool),
+        csr_matrix(
+            (
+                np.ones(len(reg_final_states_id), dtype=bool),
+                (
+                    np.zeros(len(reg_final_states_id), dtype=np.int64),
+                    reg_final_states_id,
+                ),
+            ),
+            shape=(1, reg_mat.states_count),
+            dtype=bool,
+        ),
+        format="csr",
+    )
+    graph_final_states_id = sorted(graph_mat.final_states_id)
+    final_columns = csr_matrix(
+        (
+            np.ones(len(graph_final_states_id), dtype=bool),
+            (graph_final_states_id, graph_final_states_id),
+        ),
+        shape=(graph_mat.states_count, graph_mat.states_count),
+        dtype=bool,
+    )
+    reachable = final_rows @ is_visited @ final_columns
+
+    return {
+        (start_states_id[frontier_number], reachable_state_id)
+        for frontier_number, reachable_state_id in zip(*reachable.nonzero())
+    }
+
+
+def _init_worker(graph_mat, reg_mat):
+    global _worker_matrices
+    _worker_matrices = (graph_mat, reg_mat)
 
-        for final_state in reg_mat.final_states_id:
-            reachable_states += is_visited[
-                coressponding_frontier_position + final_state, :
-            ]
 
-        reachable_vertex_id = reachable_states.nonzero()[1]
-        return {
-            graph_mat.id_state[i]
-            for i in reachable_vertex_id
-            if i in graph_mat.final_states_id
-        }
+def _bfs_chunk_in_worker(start_states_id: list[int]) -> set[tuple[int, int]]:
+    graph_mat, reg_mat = _worker_matrices
+    return _bfs_chunk(graph_mat, reg_mat, start_states_id)
 
+
+def _to_nodes(
+    graph_mat, chunk_results: Iterable[set[tuple[int, int]]]
+) -> set[tuple[int, int]]:
     return {
-        (graph_mat.id_state[start_state_id], reachable_state)
-        for frontier_number, start_state_id in enumerate(graph_mat.start_states_id)
-        for reachable_state in reachable_vertices(frontier_number)
+        (graph_mat.id_state[start_state_id], graph_mat.id_state[final_state_id])
+        for chunk_result in chunk_results
+        for start_state_id, final_state_id in chunk_result
     }
 
 
+def multiple_source_bfs(
+    graph_mat,
+    reg_mat,
+    chunk_size: int | None = None,
+    workers: int | None = None,
+    memory_limit: int | None = None,
+) -> set[tuple[int, int]]:
+    if len(graph_mat.start_states_id) == 0:
+        return set()
+
+    if chunk_size is not None and memory_limit is not None:
+        raise ValueError("Pass either chunk_size or memory_limit, not both")
+    if chunk_size is not None and chunk_size <= 0:
+        raise ValueError(f"chunk_size must be positive, got {chunk_size}")
+
+    start_states_id = sorted(graph_mat.start_states_id)
+    if memory_limit is not None:
+        chunk_size = chunk_size_for_memory(graph_mat, reg_mat, memory_limit)
+    if chunk_size is None:
+        chunk_size = len(start_states_id)
+
+    chunks = [
+        start_states_id[i : i + chunk_size]
+        for i in range(0, len(start_states_id), chunk_size)
+    ]
+
+    if workers is None or workers == 1 or len(chunks) == 1:
+        chunk_results = (_bfs_chunk(graph_mat, reg_mat, chunk) for chunk in chunks)
+        return _to_nodes(graph_mat, chunk_results)
+
+    # Label matrices are handed to every worker once, chunks only carry start ids
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_init_worker,
+        initargs=(graph_mat, reg_mat),
+    ) as executor:
+        return _to_nodes(graph_mat, executor.map(_bfs_chunk_in_worker, chunks))
+
+
 def ms_bfs_based_rpq(
-    regex: str, graph: MultiDiGraph, start_nodes: set[int], final_nodes: set[int]
+    regex: str,
+    graph: MultiDiGraph,
+    start_nodes: set[int],
+    final_nodes: set[int],
+    chunk_size: int | None = None,
+    workers: int | None = None,
+    memory_limit: int | None = None,
 ) -> set[tuple[int, int]]:
     reg_mat = AdjacencyMatrixFA(regex_to_dfa(regex))
-    graph_mat = AdjacencyMatrixFA(
-        graph_to_nfa(graph, start_states=start_nodes, final_states=final_nodes)
+    graph_mat = AdjacencyMatrixFA.from_graph(graph, start_nodes, final_nodes)
+    return multiple_source_bfs(
+        graph_mat, reg_mat, chunk_size, workers=workers, memory_limit=memory_limit
     )
-    return multiple_source_bfs(graph_mat, reg_mat)
@@ -1,10 +1,16 @@
 from networkx import MultiDiGraph
 from pyformlang.cfg import CFG
 from typing import Set, Tuple
+from collections import OrderedDict, defaultdict, deque
+from dataclasses import dataclass
 
 import pyformlang.cfg
 import networkx as nx
 
+from project.graph_lib import relevant_subgraph
+
+COMPILED_GRAMMARS_CACHE_SIZE = 128
+
 
 def cfg_to_weak_normal_form(cfg: pyformlang.cfg.CFG) -> pyformlang.cfg.CFG:
     cfg = cfg.eliminate_unit_productions()
@@ -21,63 +27,124 @@ def cfg_to_weak_normal_form(cfg: pyformlang.cfg.CFG) -> pyformlang.cfg.CFG:
     )
 
 
-def _hellings_based_cfpq(
-    cfg: CFG, graph: MultiDiGraph
-) -> Set[Tuple[int, pyformlang.cfg.Variable, int]]:
-    cfg = cfg_to_weak_normal_form(cfg)
+@dataclass(frozen=True)
+class CompiledGrammar:
+    nonterminals: tuple[pyformlang.cfg.Variable, ...]
+    start_id: int | None
+    # A for A -> eps
+    epsilon_heads: tuple[int, ...]
+    # a -> (A, ...) for A -> a
+    terminal_heads: dict[str, tuple[int, ...]]
+    # (A, B, C) for A -> B C
+    binary_productions: tuple[tuple[int, int, int], ...]
+
 
-    # A -> eps
-    epsilon_productions = set()
+_compiled_grammars: OrderedDict[tuple[str, str], CompiledGrammar] = OrderedDict()
 
-    # A -> a
-    single_terminal_productions = set()
 
-    # A -> B C
-    double_non_terminal_productions = set()
+def _compile_weak_normal_form(wcfg: pyformlang.cfg.CFG) -> CompiledGrammar:
+    nonterminal_id = {}
 
-    for production in cfg.productions:
+    def get_id(variable: pyformlang.cfg.Variable) -> int:
+        return nonterminal_id.setdefault(variable, len(nonterminal_id))
+
+    epsilon_heads = set()
+    terminal_heads = defaultdict(set)
+    binary_productions = set()
+
+    for production in wcfg.productions:
         if len(production.body) == 1:
-            single_terminal_productions.add(production)
+            terminal_heads[production.body[0].value].add(get_id(production.head))
         elif len(production.body) == 2:
-            double_non_terminal_productions.add(production)
+            binary_productions.add(
+                (
+                    get_id(production.head),
+                    get_id(production.body[0]),
+                    get_id(production.body[1]),
+                )
+            )
         else:
-            epsilon_productions.add(production)
+            epsilon_heads.add(get_id(production.head))
+
+    return CompiledGrammar(
+        nonterminals=tuple(nonterminal_id),
+        start_id=nonterminal_id.get(wcfg.start_symbol),
+        epsilon_heads=tuple(sorted(epsilon_heads)),
+        terminal_heads={
+            terminal: tuple(sorted(heads)) for terminal, heads in terminal_heads.items()
+        },
+        binary_productions=tuple(sorted(binary_productions)),
+    )
+
+
+def compile_grammar(cfg: pyformlang.cfg.CFG) -> CompiledGrammar:
+    # Production order in the text is not stable, so it is not part of the key
+    key = (
+        str(cfg.start_symbol),
+        "\n".join(sorted(cfg.to_text().splitlines())),
+    )
+    if key in _compiled_grammars:
+        _compiled_grammars.move_to_end(key)
+        return _compiled_grammars[key]
+
+    compiled_grammar = _compile_weak_normal_form(cfg_to_weak_normal_form(cfg))
+    _compiled_grammars[key] = compiled_grammar
+    if len(_compiled_grammars) > COMPILED_GRAMMARS_CACHE_SIZE:
+        _compiled_grammars.popitem(last=False)
+    return compiled_grammar
 
-    result = set()
 
-    for production in epsilon_productions:
+def _hellings_based_cfpq(
+    cfg: CFG, graph: MultiDiGraph
+) -> Set[Tuple[int, pyformlang.cfg.Variable, int]]:
+    grammar = compile_grammar(cfg)
+
+    # B -> [(A, C)] and C -> [(A, B)] for A -> B C
+    productions_by_first = defaultdict(list)
+    productions_by_second = defaultdict(list)
+
+    for head, first, second in grammar.binary_productions:
+        productions_by_first[first].append((head, second))
+        productions_by_second[second].append((head, first))
+
+    result = set()
+    # (n, N) -> {m} and (m, N) -> {n} for every known (n, N, m)
+    ends_by_start = defaultdict(set)
+    starts_by_end = defaultdict(set)
+    new = deque()
+
+    def add_triple(n, N, m):
+        if (n, N, m) not in result:
+            result.add((n, N, m))
+            ends_by_start[(n, N)].add(m)
+            starts_by_end[(m, N)].add(n)
+            new.append((n, N, m))
+
+    for head in grammar.epsilon_heads:
         for node in graph.nodes:
-            result.add((node, production.head, node))
+            add_triple(node, head, node)
 
     for n, m, label in graph.edges(data="label"):
-        for production in single_terminal_productions:
-            if label == production.body[0].value:
-                result.add((n, production.head, m))
-
-    new = set(result)
+        for head in grammar.terminal_heads.get(label, ()):
+            add_triple(n, head, m)
 
     while new:
-        # Pick and remove an (n, N, m) from new
-        (n, N, m) = new.pop()
+        (n, N, m) = new.popleft()
 
-        for n_prime, M, m_prime in list(result):
-            if m_prime == n:
-                for production in double_non_terminal_productions:
-                    if production.body[0] == M and production.body[1] == N:
-                        new_triple = (n_prime, production.head, m)
-                        if new_triple not in result:
-                            new.add(new_triple)
-                            result.add(new_triple)
+        derived = [
+            (n_prime, head, m)
+            for head, M in productions_by_second.get(N, [])
+            for n_prime in starts_by_end.get((n, M), ())
+        ] + [
+            (n, head, m_prime)
+            for head, M in productions_by_first.get(N, [])
+            for m_prime in ends_by_start.get((m, M), ())
+        ]
 
-            if n_prime == m:
-                for production in double_non_terminal_productions:
-                    if production.body[0] == N and production.body[1] == M:
-                        new_triple = (n, production.head, m_prime)
-                        if new_triple not in result:
-                            new.add(new_triple)
-                            result.add(new_triple)
+        for triple in derived:
+            add_triple(*triple)
 
-    return result
+    return {(n, grammar.nonterminals[N], m) for n, N, m in result}
 
 
 def hellings_based_cfpq(
@@ -85,11 +152,16 @@ def hellings_based_cfpq(
     graph: nx.DiGraph,
     start_nodes: Set[int] = None,
     final_nodes: Set[int] = None,
+    restrict_to_sources: bool = True,
 ) -> Set[Tuple[int, int]]:
+    if restrict_to_sources:
+        graph = relevant_subgraph(graph, start_nodes, final_nodes)
     result = _hellings_based_cfpq(cfg, graph)
 
     return {
         (n, m)
         for n, var, m in result
-        if var == cfg.start_symbol and n in start_nodes and m in final_nodes
+        if var == cfg.start_symbol
+        and (start_nodes is None or n in start_nodes)
+        and (final_nodes is None or m in final_nodes)
     }
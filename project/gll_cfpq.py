@@ -1,188 +1,333 @@
-from dataclasses import dataclass
-from typing import Dict, Set, Tuple
+from abc import ABC, abstractmethod
+from collections import deque
+from typing import Iterator, Set, Tuple
 from pyformlang import rsa
 import networkx as nx
 
+from project.graph_lib import graph_to_matrices
+from project.tensor_cfpq import CompiledRSM
 
-@dataclass(frozen=True)
-class AutomatonState:
-    variable: str
-    substate: str
+# The GSS node every start descriptor returns to
+ACCEPT_GSS_NODE = 0
 
 
-@dataclass(frozen=True)
-class ParseForestNode:
-    gss_node: "GSSNode"
-    state: AutomatonState
-    node_id: int
+class DescriptorScheduler(ABC):
+    def __init__(self, states_count: int, nodes_count: int):
+        self.states_count = states_count
+        self.nodes_count = nodes_count
 
+    @abstractmethod
+    def __len__(self) -> int:
+        pass
 
-class GSSNode:
-    def __init__(self, state: AutomatonState, node_id: int):
-        self.state = state
-        self.node_id = node_id
-        self.refs = {}
-        self.visited_nodes = set()
+    @abstractmethod
+    def push(self, gss: int, state: int, node: int):
+        pass
 
-    def pop(self, current_node_id: int) -> Set[ParseForestNode]:
-        if current_node_id in self.visited_nodes:
-            return set()
-        self.visited_nodes.add(current_node_id)
-        return {
-            ParseForestNode(gss, state, current_node_id)
-            for state, gss_list in self.refs.items()
-            for gss in gss_list
-        }
+    @abstractmethod
+    def pop_batch(self) -> Tuple[int, int, list[int]]:
+        pass
 
-    def add_ref(
-        self, return_state: AutomatonState, gss_node: "GSSNode"
-    ) -> Set[ParseForestNode]:
-        if gss_node in self.refs.setdefault(return_state, set()):
-            return set()
-        self.refs[return_state].add(gss_node)
-        return {
-            ParseForestNode(gss_node, return_state, current_node)
-            for current_node in self.visited_nodes
-        }
 
+class FIFOScheduler(DescriptorScheduler):
+    def __init__(self, states_count: int, nodes_count: int):
+        super().__init__(states_count, nodes_count)
+        self.descriptors = deque()
+
+    def __len__(self) -> int:
+        return len(self.descriptors)
+
+    def push(self, gss: int, state: int, node: int):
+        self.descriptors.append(
+            (gss * self.states_count + state) * self.nodes_count + node
+        )
+
+    def _pop(self) -> int:
+        return self.descriptors.popleft()
+
+    def pop_batch(self) -> Tuple[int, int, list[int]]:
+        rest, node = divmod(self._pop(), self.nodes_count)
+        gss, state = divmod(rest, self.states_count)
+        return state, node, [gss]
+
+
+class LIFOScheduler(FIFOScheduler):
+    def _pop(self) -> int:
+        return self.descriptors.pop()
+
+
+class _GroupedScheduler(DescriptorScheduler):
+    # Descriptors are grouped by an outer key, then by the remaining part of
+    # (state, node), and a batch is every GSS node waiting at one (state, node)
+    def __init__(self, states_count: int, nodes_count: int):
+        super().__init__(states_count, nodes_count)
+        self.groups = {}
+        self.order = deque()
+        self.size = 0
+
+    def __len__(self) -> int:
+        return self.size
 
-@dataclass
-class AutomatonStateData:
-    terminal_edges: Dict[str, AutomatonState]
-    variable_edges: Dict[str, Tuple[AutomatonState, AutomatonState]]
-    is_final_state: bool
+    @abstractmethod
+    def _split(self, state: int, node: int) -> Tuple[int, int]:
+        pass
+
+    @abstractmethod
+    def _join(self, outer: int, inner: int) -> Tuple[int, int]:
+        pass
+
+    def push(self, gss: int, state: int, node: int):
+        outer, inner = self._split(state, node)
+        group = self.groups.get(outer)
+        if group is None:
+            group = self.groups[outer] = {}
+            self.order.append(outer)
+        group.setdefault(inner, []).append(gss)
+        self.size += 1
+
+    def pop_batch(self) -> Tuple[int, int, list[int]]:
+        outer = self.order[0]
+        group = self.groups[outer]
+        inner, gss_nodes = group.popitem()
+        if not group:
+            del self.groups[outer]
+            self.order.popleft()
+        self.size -= len(gss_nodes)
+        return *self._join(outer, inner), gss_nodes
+
+
+class NodeGroupedScheduler(_GroupedScheduler):
+    def _split(self, state: int, node: int) -> Tuple[int, int]:
+        return node, state
+
+    def _join(self, outer: int, inner: int) -> Tuple[int, int]:
+        return inner, outer
+
+
+class StateGroupedScheduler(_GroupedScheduler):
+    def _split(self, state: int, node: int) -> Tuple[int, int]:
+        return state, node
+
+    def _join(self, outer: int, inner: int) -> Tuple[int, int]:
+        return outer, inner
+
+
+SCHEDULERS = {
+    "fifo": FIFOScheduler,
+    "lifo": LIFOScheduler,
+    "node": NodeGroupedScheduler,
+    "state": StateGroupedScheduler,
+}
 
 
 class GLLParser:
-    def __init__(self, rsm: rsa.RecursiveAutomaton, graph: nx.DiGraph):
-        self.node_edges = {
-            node: {
-                symbol: set() for _, _, symbol in graph.edges(data="label") if symbol
-            }
-            for node in graph.nodes()
-        }
+    def __init__(
+        self,
+        rsm: rsa.RecursiveAutomaton | CompiledRSM,
+        graph: nx.DiGraph,
+        scheduler: str | type[DescriptorScheduler] = "lifo",
+    ):
+        if isinstance(scheduler, str):
+            if scheduler not in SCHEDULERS:
+                raise ValueError(
+                    f"Unknown scheduler {scheduler!r}, expected one of {tuple(SCHEDULERS)}"
+                )
+            scheduler = SCHEDULERS[scheduler]
 
-        self.state_data = {
-            variable: {
-                state: AutomatonStateData({}, {}, state in box.dfa.final_states)
-                for state in box.dfa.to_networkx().nodes
-            }
-            for variable, box in rsm.boxes.items()
+        compiled_rsm = (
+            rsm if isinstance(rsm, CompiledRSM) else CompiledRSM.from_rsm(rsm)
+        )
+
+        graph_matrices = graph_to_matrices(graph, set(), set())
+        self.nodes = graph_matrices.nodes
+        self.node_id = {node: index for index, node in enumerate(self.nodes)}
+        self.nodes_count = max(len(self.nodes), 1)
+
+        # Successors of node by label are indices[indptr[node] : indptr[node + 1]]
+        self.label_edges = {
+            label: (matrix.indptr, matrix.indices)
+            for label, matrix in graph_matrices.bool_decomposition.items()
         }
 
-        self.start_state = AutomatonState(
-            rsm.initial_label, rsm.boxes[rsm.initial_label].dfa.start_state.value
-        )
+        # RSM states are the integer ids of the compiled RSM
+        self.states_count = max(compiled_rsm.states_count, 1)
+        self.terminal_edges = [{} for _ in range(compiled_rsm.states_count)]
+        self.call_edges = [[] for _ in range(compiled_rsm.states_count)]
+        self.is_final_state = [False] * compiled_rsm.states_count
+        for finals in compiled_rsm.box_finals.values():
+            for state in finals:
+                self.is_final_state[state] = True
 
-        self.graph = graph
-        self.pending_nodes = set()
-        self.added_nodes = set()
-
-        self.accept_gss_node = GSSNode(AutomatonState("$", "fin"), None)
-        self.gss_nodes = {}
-
-        for from_node, to_node, symbol in graph.edges(data="label"):
-            if symbol:
-                self.node_edges[from_node].setdefault(symbol, set()).add(to_node)
-
-        for variable, box in rsm.boxes.items():
-            for from_state, to_state, symbol in box.dfa.to_networkx().edges(
-                data="label"
-            ):
-                if symbol:
-                    state_data = self.state_data[variable][from_state]
-                    if symbol in rsm.boxes:
-                        sub_box = rsm.boxes[symbol].dfa
-                        state_data.variable_edges[symbol] = (
-                            AutomatonState(symbol, sub_box.start_state.value),
-                            AutomatonState(variable, to_state),
-                        )
-                    else:
-                        state_data.terminal_edges[symbol] = AutomatonState(
-                            variable, to_state
+        for symbol, matrix in compiled_rsm.bool_decomposition.items():
+            for from_state, to_state in zip(*matrix.nonzero()):
+                if symbol in compiled_rsm.box_starts:
+                    for box_start in compiled_rsm.box_starts[symbol]:
+                        self.call_edges[from_state].append(
+                            (int(box_start), int(to_state))
                         )
+                else:
+                    self.terminal_edges[from_state][symbol] = int(to_state)
 
-    def get_gss_node(self, state: AutomatonState, node_id: int) -> GSSNode:
-        if (state, node_id) not in self.gss_nodes:
-            self.gss_nodes[(state, node_id)] = GSSNode(state, node_id)
-        return self.gss_nodes[(state, node_id)]
-
-    def add_parse_nodes(self, nodes: Set[ParseForestNode]):
-        new_nodes = nodes - self.added_nodes
-        self.added_nodes.update(new_nodes)
-        self.pending_nodes.update(new_nodes)
-
-    def process_popped_nodes(
-        self, nodes: Set[ParseForestNode], previous_node: ParseForestNode
-    ) -> Tuple[Set[ParseForestNode], Set[Tuple[int, int]]]:
-        return {node for node in nodes if node.gss_node != self.accept_gss_node}, {
-            (previous_node.gss_node.node_id, node.node_id)
-            for node in nodes
-            if node.gss_node == self.accept_gss_node
-        }
+        initial_starts = compiled_rsm.box_starts.get(compiled_rsm.initial_label, [])
+        self.start_states = [int(state) for state in initial_starts]
 
-    def _gll_based_cfpq(
-        self, from_nodes: Set[int], to_nodes: Set[int]
-    ) -> Set[Tuple[int, int]]:
-        reachable_pairs = set()
-        for node_id in from_nodes:
-            gss_node = self.get_gss_node(self.start_state, node_id)
-            gss_node.add_ref(AutomatonState("$", "fin"), self.accept_gss_node)
-            self.add_parse_nodes({ParseForestNode(gss_node, self.start_state, node_id)})
-
-        while self.pending_nodes:
-            parse_node = self.pending_nodes.pop()
-            state_data = self.state_data[parse_node.state.variable][
-                parse_node.state.substate
-            ]
-
-            for terminal, new_state in state_data.terminal_edges.items():
-                if terminal in self.node_edges[parse_node.node_id]:
-                    self.add_parse_nodes(
-                        {
-                            ParseForestNode(parse_node.gss_node, new_state, new_node_id)
-                            for new_node_id in self.node_edges[parse_node.node_id][
-                                terminal
-                            ]
-                        }
-                    )
-
-            for _, (
-                start_rsm_state,
-                return_rsm_state,
-            ) in state_data.variable_edges.items():
-                sub_node = self.get_gss_node(start_rsm_state, parse_node.node_id)
-                popped_nodes = sub_node.add_ref(return_rsm_state, parse_node.gss_node)
-                popped_nodes, sub_reachable_pairs = self.process_popped_nodes(
-                    popped_nodes, parse_node
-                )
-                self.add_parse_nodes(popped_nodes)
-                self.add_parse_nodes(
-                    {ParseForestNode(sub_node, start_rsm_state, parse_node.node_id)}
-                )
-                reachable_pairs.update(sub_reachable_pairs)
+        # GSS nodes are ids into these lists, the accept node has no state
+        self.gss_state = [-1]
+        self.gss_node = [-1]
+        # caller * states_count + return state for every GSS edge
+        self.gss_edges = [set()]
+        self.gss_popped = [set()]
+        self.gss_ids = {}
 
-            if state_data.is_final_state:
-                new_parse_nodes = parse_node.gss_node.pop(parse_node.node_id)
-                new_parse_nodes, start_end_pairs = self.process_popped_nodes(
-                    new_parse_nodes, parse_node
-                )
-                self.add_parse_nodes(new_parse_nodes)
-                reachable_pairs.update(start_end_pairs)
+        # Descriptors are (gss * states_count + state) * nodes_count + node
+        self.added_descriptors = set()
+        self.pending_descriptors = scheduler(self.states_count, self.nodes_count)
+        self.reachable_pairs = set()
+        self.new_pairs = []
+
+    def get_gss_node(self, state: int, node: int) -> int:
+        key = state * self.nodes_count + node
+        gss = self.gss_ids.get(key)
+        if gss is None:
+            gss = len(self.gss_state)
+            self.gss_ids[key] = gss
+            self.gss_state.append(state)
+            self.gss_node.append(node)
+            self.gss_edges.append(set())
+            self.gss_popped.append(set())
+        return gss
+
+    def add_descriptor(self, gss: int, state: int, node: int):
+        descriptor = (gss * self.states_count + state) * self.nodes_count + node
+        if descriptor not in self.added_descriptors:
+            self.added_descriptors.add(descriptor)
+            self.pending_descriptors.push(gss, state, node)
+
+    def _return(self, caller: int, return_state: int, gss: int, node: int):
+        if caller == ACCEPT_GSS_NODE:
+            pair = (self.gss_node[gss], node)
+            if pair not in self.reachable_pairs:
+                self.reachable_pairs.add(pair)
+                self.new_pairs.append(pair)
+        else:
+            self.add_descriptor(caller, return_state, node)
+
+    def pop(self, gss: int, node: int):
+        if node in self.gss_popped[gss]:
+            return
+        self.gss_popped[gss].add(node)
+        for edge in self.gss_edges[gss]:
+            caller, return_state = divmod(edge, self.states_count)
+            self._return(caller, return_state, gss, node)
+
+    def add_gss_edge(self, gss: int, return_state: int, caller: int):
+        edge = caller * self.states_count + return_state
+        if edge in self.gss_edges[gss]:
+            return
+        self.gss_edges[gss].add(edge)
+        # Results the callee already produced in earlier work are reused here
+        for node in self.gss_popped[gss]:
+            self._return(caller, return_state, gss, node)
+
+    def _process_batch(
+        self, state: int, node: int, gss_nodes: list[int]
+    ) -> list[Tuple[int, int]]:
+        self.new_pairs = []
+
+        # Successors and callees depend only on (state, node), so they are
+        # found once for every GSS node of the batch
+        for terminal, next_state in self.terminal_edges[state].items():
+            if terminal not in self.label_edges:
+                continue
+            indptr, indices = self.label_edges[terminal]
+            next_nodes = indices[indptr[node] : indptr[node + 1]].tolist()
+            for gss in gss_nodes:
+                for next_node in next_nodes:
+                    self.add_descriptor(gss, next_state, next_node)
+
+        for box_start, return_state in self.call_edges[state]:
+            callee = self.get_gss_node(box_start, node)
+            for gss in gss_nodes:
+                self.add_gss_edge(callee, return_state, gss)
+            self.add_descriptor(callee, box_start, node)
+
+        if self.is_final_state[state]:
+            for gss in gss_nodes:
+                self.pop(gss, node)
+        return self.new_pairs
+
+    def _add_start_nodes(self, start_nodes: Set[int] | None) -> Set[int]:
+        self.new_pairs = []
+        start_nodes = set(self.node_id) if start_nodes is None else start_nodes
+        start_ids = {self.node_id[node] for node in start_nodes if node in self.node_id}
+
+        # GSS nodes, their popped sets and seen descriptors are kept between
+        # queries, so start nodes met before as call sites finish immediately
+        for node in start_ids:
+            for start_state in self.start_states:
+                gss = self.get_gss_node(start_state, node)
+                self.add_gss_edge(gss, 0, ACCEPT_GSS_NODE)
+                self.add_descriptor(gss, start_state, node)
+        return start_ids
+
+    def query(
+        self, start_nodes: Set[int] = None, final_nodes: Set[int] = None
+    ) -> Set[Tuple[int, int]]:
+        start_ids = self._add_start_nodes(start_nodes)
+        while self.pending_descriptors:
+            self._process_batch(*self.pending_descriptors.pop_batch())
 
         return {
-            (start_node, end_node)
-            for start_node, end_node in reachable_pairs
-            if end_node in to_nodes
+            (self.nodes[start_node], self.nodes[end_node])
+            for start_node, end_node in self.reachable_pairs
+            if start_node in start_ids
+            and (final_nodes is None or self.nodes[end_node] in final_nodes)
         }
 
+    def iter_query(
+        self,
+        start_nodes: Set[int] = None,
+        final_nodes: Set[int] = None,
+        limit: int | None = None,
+    ) -> Iterator[Tuple[int, int]]:
+        if limit == 0:
+            return
+        start_ids = self._add_start_nodes(start_nodes)
+        yielded = set()
+
+        # Known pairs go first, then the pairs of each batch of descriptors once
+        # it is fully processed, so stopping early leaves the rest of the worklist
+        # intact for later queries. The last sweep catches pairs found by other
+        # queries while this one was suspended
+        found = list(self.reachable_pairs)
+        last_sweep = False
+        while True:
+            for pair in found:
+                if pair in yielded or pair[0] not in start_ids:
+                    continue
+                if final_nodes is not None and self.nodes[pair[1]] not in final_nodes:
+                    continue
+                yielded.add(pair)
+                yield self.nodes[pair[0]], self.nodes[pair[1]]
+                if len(yielded) == limit:
+                    return
+
+            if self.pending_descriptors:
+                found = self._process_batch(*self.pending_descriptors.pop_batch())
+            elif not last_sweep:
+                last_sweep = True
+                found = list(self.reachable_pairs)
+            else:
+                return
+
 
 def gll_based_cfpq(
-    rsm: rsa.RecursiveAutomaton,
+    rsm: rsa.RecursiveAutomaton | CompiledRSM,
     graph: nx.DiGraph,
     start_nodes: Set[int] = None,
     final_nodes: Set[int] = None,
+    scheduler: str | type[DescriptorScheduler] = "lifo",
 ) -> Set[Tuple[int, int]]:
-    return GLLParser(rsm, graph)._gll_based_cfpq(
-        start_nodes or set(graph.nodes()), final_nodes or set(graph.nodes())
+    return GLLParser(rsm, graph, scheduler).query(
+        start_nodes or None, final_nodes or None
     )
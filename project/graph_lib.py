@@ -1,7 +1,11 @@
 from dataclasses import dataclass
-from typing import Iterable, Any
+from pathlib import Path
+from typing import Iterable, Any, Set
 import cfpq_data
 import networkx as nx
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix
 
 
 @dataclass
@@ -11,10 +15,150 @@ class GraphInfo:
     edge_labels: set
 
 
+@dataclass
+class GraphMatrices:
+    nodes: list[Any]
+    start_nodes_id: Set[int]
+    final_nodes_id: Set[int]
+    bool_decomposition: dict[Any, csr_matrix]
+
+
 def get_graph_by_name(graph_name: str) -> nx.MultiDiGraph:
     return cfpq_data.graph_from_csv(cfpq_data.download(graph_name))
 
 
+def _label_matrices(
+    rows: np.ndarray, cols: np.ndarray, labels: np.ndarray, nodes_count: int
+) -> dict[Any, csr_matrix]:
+    label_values, label_codes = np.unique(labels, return_inverse=True)
+    order = np.argsort(label_codes, kind="stable")
+    bounds = np.searchsorted(label_codes[order], np.arange(len(label_values) + 1))
+
+    bool_decomposition = {}
+    for code, label in enumerate(label_values):
+        edges = order[bounds[code] : bounds[code + 1]]
+        bool_decomposition[label] = csr_matrix(
+            (np.ones(len(edges), dtype=bool), (rows[edges], cols[edges])),
+            shape=(nodes_count, nodes_count),
+            dtype=bool,
+        )
+    return bool_decomposition
+
+
+def graph_to_matrices(
+    graph: nx.MultiDiGraph, start_nodes: Set[Any], final_nodes: Set[Any]
+) -> GraphMatrices:
+    nodes = list(graph.nodes)
+    node_id = {node: index for index, node in enumerate(nodes)}
+
+    if len(start_nodes) == 0:
+        start_nodes = nodes
+    if len(final_nodes) == 0:
+        final_nodes = nodes
+
+    start_nodes_id = {node_id[node] for node in start_nodes if node in node_id} | {
+        node_id[node] for node, is_start in graph.nodes(data="is_start") if is_start
+    }
+    final_nodes_id = {node_id[node] for node in final_nodes if node in node_id} | {
+        node_id[node] for node, is_final in graph.nodes(data="is_final") if is_final
+    }
+
+    rows, cols, labels = [], [], []
+    for from_node, to_node, label in graph.edges(data="label"):
+        if label is not None:
+            rows.append(node_id[from_node])
+            cols.append(node_id[to_node])
+            labels.append(label)
+
+    return GraphMatrices(
+        nodes=nodes,
+        start_nodes_id=start_nodes_id,
+        final_nodes_id=final_nodes_id,
+        bool_decomposition=_label_matrices(
+            np.array(rows, dtype=np.int64),
+            np.array(cols, dtype=np.int64),
+            np.array(labels, dtype=object),
+            len(nodes),
+        ),
+    )
+
+
+def csv_to_matrices(
+    path: Path | str, start_nodes: Set[Any], final_nodes: Set[Any]
+) -> GraphMatrices:
+    # Same edge list format as cfpq_data.graph_from_csv
+    data = pd.read_csv(
+        filepath_or_buffer=path,
+        sep=" ",
+        header=None,
+        names=["from", "to", "label"],
+        engine="c",
+    )
+    nodes, node_ids = np.unique(
+        np.concatenate([data["from"].to_numpy(), data["to"].to_numpy()]),
+        return_inverse=True,
+    )
+    rows, cols = np.split(node_ids, 2)
+
+    all_nodes_id = set(range(len(nodes)))
+
+    def to_nodes_id(selected_nodes: Set[Any]) -> Set[int]:
+        if len(selected_nodes) == 0:
+            return all_nodes_id
+        selected_nodes = np.asarray(list(selected_nodes), dtype=nodes.dtype)
+        positions = np.minimum(np.searchsorted(nodes, selected_nodes), len(nodes) - 1)
+        return set(positions[nodes[positions] == selected_nodes].tolist())
+
+    return GraphMatrices(
+        nodes=nodes.tolist(),
+        start_nodes_id=to_nodes_id(start_nodes),
+        final_nodes_id=to_nodes_id(final_nodes),
+        bool_decomposition=_label_matrices(
+            rows, cols, data["label"].to_numpy(dtype=object), len(nodes)
+        ),
+    )
+
+
+def _reachable_nodes(sources: Iterable[Any], neighbors, allowed=None) -> Set[Any]:
+    visited = set(sources)
+    stack = list(visited)
+    while stack:
+        for neighbor in neighbors(stack.pop()):
+            if neighbor not in visited and (allowed is None or neighbor in allowed):
+                visited.add(neighbor)
+                stack.append(neighbor)
+    return visited
+
+
+def relevant_subgraph(
+    graph: nx.MultiDiGraph,
+    start_nodes: Set[Any] | None = None,
+    final_nodes: Set[Any] | None = None,
+) -> nx.MultiDiGraph:
+    # Every path from a start to a final node stays inside the nodes that are
+    # reachable from the starts and can reach the finals
+    if start_nodes is None and final_nodes is None:
+        return graph
+    start_nodes = graph.nodes if start_nodes is None else start_nodes
+    final_nodes = graph.nodes if final_nodes is None else final_nodes
+
+    forward = _reachable_nodes(
+        (node for node in start_nodes if node in graph), graph.successors
+    )
+    relevant = _reachable_nodes(
+        (node for node in final_nodes if node in forward),
+        graph.predecessors,
+        forward,
+    )
+    return graph.subgraph(relevant)
+
+
+def get_graph_matrices_by_name(
+    graph_name: str, start_nodes: Set[Any], final_nodes: Set[Any]
+) -> GraphMatrices:
+    return csv_to_matrices(cfpq_data.download(graph_name), start_nodes, final_nodes)
+
+
 def get_graph_info_by_name(graph_name: str) -> GraphInfo:
     graph = get_graph_by_name(graph_name)
     return GraphInfo(
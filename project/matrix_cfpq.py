@@ -3,86 +3,359 @@ import scipy
 import networkx as nx
 
 
-from project.cfpq_hellings import cfg_to_weak_normal_form
-from typing import Set
-from collections import defaultdict
+from project.adjacency_matrix_fa import bool_matrix_from_indices
+from project.cfpq_hellings import compile_grammar
+from project.graph_lib import relevant_subgraph
+from typing import Any, Iterable, Set, Tuple
+from collections import Counter, defaultdict
 
 
-def _matrix_based_cfpq(cfg, graph):
-    node_id = {node: index for index, node in enumerate(graph.nodes)}
-    id_node = {index: node for node, index in node_id.items()}
+class NonterminalMatrixStore:
+    def __init__(self, nonterminals_count: int, size: int):
+        self.size = size
+        self._matrices: list[scipy.sparse.csr_matrix | None] = [
+            None
+        ] * nonterminals_count
+        self._empty = scipy.sparse.csr_matrix((size, size), dtype=bool)
 
-    wcfg = cfg_to_weak_normal_form(cfg)
+    def __getitem__(self, nonterminal: int) -> scipy.sparse.csr_matrix:
+        matrix = self._matrices[nonterminal]
+        return self._empty if matrix is None else matrix
 
-    # A -> eps
-    epsilon_productions = set()
+    def __contains__(self, nonterminal: int) -> bool:
+        return self._matrices[nonterminal] is not None
 
-    # A -> a
-    single_terminal_productions = defaultdict(list)
+    def items(self):
+        for nonterminal, matrix in enumerate(self._matrices):
+            if matrix is not None:
+                yield nonterminal, matrix
 
-    # A -> B C
-    double_non_terminal_productions = set()
+    def resize(self, size: int):
+        self.size = size
+        self._empty = scipy.sparse.csr_matrix((size, size), dtype=bool)
+        for _, matrix in self.items():
+            matrix.resize((size, size))
 
-    for production in wcfg.productions:
-        if len(production.body) == 1:
-            single_terminal_productions[production.body[0].value].append(
-                production.head
-            )
-        elif len(production.body) == 2:
-            double_non_terminal_productions.add(
-                (production.head, production.body[0], production.body[1])
-            )
+    def default(self) -> scipy.sparse.csr_matrix:
+        return self._empty
+
+    def nnz(self) -> int:
+        return sum(matrix.nnz for _, matrix in self.items())
+
+    def accumulate(
+        self, nonterminal: int, update: scipy.sparse.csr_matrix
+    ) -> scipy.sparse.csr_matrix:
+        current = self._matrices[nonterminal]
+        if current is None:
+            delta = scipy.sparse.csr_matrix(update, dtype=bool)
+            delta.eliminate_zeros()
         else:
-            epsilon_productions.add(production.head)
+            delta = update > current
+        # The stored matrix is only replaced when something new was derived
+        if delta.nnz != 0:
+            self._matrices[nonterminal] = delta if current is None else current + delta
+        return delta
 
-    bool_decomposition = defaultdict(
-        lambda: scipy.sparse.csr_matrix(
-            (graph.number_of_nodes(), graph.number_of_nodes()), dtype=bool
-        )
-    )
+    def discard(self, nonterminal: int, removed: scipy.sparse.csr_matrix):
+        current = self._matrices[nonterminal]
+        if current is None:
+            return
+        remaining = current > removed
+        self._matrices[nonterminal] = remaining if remaining.nnz != 0 else None
 
-    for start, finish, attributes in graph.edges.data():
-        for nonterminal in single_terminal_productions[attributes["label"]]:
-            bool_decomposition[nonterminal][node_id[start], node_id[finish]] = True
 
-    for node_id in range(graph.number_of_nodes()):
-        for var in epsilon_productions:
-            bool_decomposition[var][node_id, node_id] = True
+def _naive_fixpoint(
+    store: NonterminalMatrixStore, double_non_terminal_productions
+) -> int:
+    count = 0
+    changed = True
+    while changed:
+        count += 1
+        changed = False
+        for hd, nonterminal_1, nonterminal_2 in double_non_terminal_productions:
+            if nonterminal_1 not in store or nonterminal_2 not in store:
+                continue
+            delta = store.accumulate(hd, store[nonterminal_1].dot(store[nonterminal_2]))
+            changed = changed or delta.nnz != 0
+    return count
+
 
-    last_nonzero_number = 0
-    current_nonzero_number = sum(
-        matrix.count_nonzero() for matrix in bool_decomposition.values()
-    )
+def _semi_naive_fixpoint(
+    store: NonterminalMatrixStore, double_non_terminal_productions, delta=None
+) -> int:
+    # Without an explicit delta every fact known before the first round is new
+    delta = dict(store.items()) if delta is None else delta
     count = 0
-    while last_nonzero_number != current_nonzero_number:
+    while delta:
         count += 1
+        derived = {}
         for hd, nonterminal_1, nonterminal_2 in double_non_terminal_productions:
-            bool_decomposition[hd] += bool_decomposition[nonterminal_1].dot(
-                bool_decomposition[nonterminal_2]
-            )
+            if nonterminal_1 not in delta and nonterminal_2 not in delta:
+                continue
 
-        last_nonzero_number = current_nonzero_number
-        current_nonzero_number = sum(
-            matrix.count_nonzero() for matrix in bool_decomposition.values()
-        )
+            # B·C only differs from the previous round in ΔB·C + B·ΔC
+            if nonterminal_1 in delta:
+                product = delta[nonterminal_1].dot(store[nonterminal_2])
+                if nonterminal_2 in delta:
+                    product += store[nonterminal_1].dot(delta[nonterminal_2])
+            else:
+                product = store[nonterminal_1].dot(delta[nonterminal_2])
+            derived[hd] = derived[hd] + product if hd in derived else product
+
+        delta = {}
+        for hd, product in derived.items():
+            new_facts = store.accumulate(hd, product)
+            if new_facts.nnz != 0:
+                delta[hd] = new_facts
+    return count
+
+
+def _matrix_based_cfpq(cfg, graph, semi_naive: bool = True, stats: dict = None):
+    node_id = {node: index for index, node in enumerate(graph.nodes)}
+    id_node = list(graph.nodes)
+    nodes_count = len(id_node)
+
+    grammar = compile_grammar(cfg)
+    store = NonterminalMatrixStore(len(grammar.nonterminals), nodes_count)
+
+    facts = defaultdict(lambda: ([], []))
+    for start, finish, label in graph.edges.data("label"):
+        for nonterminal in grammar.terminal_heads.get(label, ()):
+            rows, cols = facts[nonterminal]
+            rows.append(node_id[start])
+            cols.append(node_id[finish])
+
+    for nonterminal in grammar.epsilon_heads:
+        rows, cols = facts[nonterminal]
+        rows.extend(range(nodes_count))
+        cols.extend(range(nodes_count))
+
+    for nonterminal, (rows, cols) in facts.items():
+        store.accumulate(nonterminal, bool_matrix_from_indices(rows, cols, nodes_count))
+
+    if semi_naive:
+        rounds = _semi_naive_fixpoint(store, grammar.binary_productions)
+    else:
+        rounds = _naive_fixpoint(store, grammar.binary_productions)
+    if stats is not None:
+        stats["rounds"] = rounds
 
     result = {
-        (id_node[i], nonterminal, id_node[j])
-        for nonterminal, bool_matrix in bool_decomposition.items()
+        (id_node[i], grammar.nonterminals[nonterminal], id_node[j])
+        for nonterminal, bool_matrix in store.items()
         for i, j in zip(*bool_matrix.nonzero())
     }
     return result
 
 
+class IncrementalMatrixCFPQ:
+    def __init__(self, cfg: pyformlang.cfg.CFG, graph: nx.DiGraph = None):
+        self.cfg = cfg
+        self._grammar = compile_grammar(cfg)
+        self.nodes = []
+        self.node_id = {}
+        self._store = NonterminalMatrixStore(len(self._grammar.nonterminals), 0)
+
+        # Facts given directly by edges and epsilon productions, with the number
+        # of edges and epsilon productions supporting each of them
+        self._base = NonterminalMatrixStore(len(self._grammar.nonterminals), 0)
+        self._base_support = Counter()
+        self._edges = Counter()
+        self._incident_edges = defaultdict(set)
+
+        if graph is not None:
+            self.add_nodes(graph.nodes)
+            self.add_edges(graph.edges(data="label"))
+
+    def _facts_matrices(self, facts) -> dict:
+        return {
+            nonterminal: bool_matrix_from_indices(rows, cols, len(self.nodes))
+            for nonterminal, (rows, cols) in facts.items()
+        }
+
+    def _register_nodes(self, nodes: Iterable[Any]) -> list[int]:
+        new_ids = []
+        for node in nodes:
+            if node not in self.node_id:
+                self.node_id[node] = len(self.nodes)
+                self.nodes.append(node)
+                new_ids.append(self.node_id[node])
+        if new_ids:
+            self._store.resize(len(self.nodes))
+            self._base.resize(len(self.nodes))
+        return new_ids
+
+    def _propagate(self, facts: dict):
+        delta = {}
+        for nonterminal, matrix in facts.items():
+            new_facts = self._store.accumulate(nonterminal, matrix)
+            if new_facts.nnz != 0:
+                delta[nonterminal] = new_facts
+        if delta:
+            _semi_naive_fixpoint(self._store, self._grammar.binary_productions, delta)
+
+    def _support(self, nonterminal: int, start: int, finish: int, count: int, facts):
+        fact = (nonterminal, start, finish)
+        support = self._base_support.pop(fact, 0)
+        # Facts are added or removed when their support appears or runs out
+        if support == 0 or support + count == 0:
+            rows, cols = facts[nonterminal]
+            rows.append(start)
+            cols.append(finish)
+        if support + count != 0:
+            self._base_support[fact] = support + count
+
+    def _epsilon_facts(self, node_ids: list[int], count: int, facts):
+        for nonterminal in self._grammar.epsilon_heads:
+            for node_id in node_ids:
+                self._support(nonterminal, node_id, node_id, count, facts)
+
+    def _add_base_facts(self, facts):
+        matrices = self._facts_matrices(facts)
+        for nonterminal, matrix in matrices.items():
+            self._base.accumulate(nonterminal, matrix)
+        self._propagate(matrices)
+
+    def add_nodes(self, nodes: Iterable[Any]):
+        facts = defaultdict(lambda: ([], []))
+        self._epsilon_facts(self._register_nodes(nodes), 1, facts)
+        self._add_base_facts(facts)
+
+    def add_edges(self, edges: Iterable[Tuple[Any, Any, Any]]):
+        edges = list(edges)
+        facts = defaultdict(lambda: ([], []))
+        self._epsilon_facts(
+            self._register_nodes(node for edge in edges for node in edge[:2]), 1, facts
+        )
+
+        for start, finish, label in edges:
+            edge = (self.node_id[start], self.node_id[finish], label)
+            self._edges[edge] += 1
+            self._incident_edges[edge[0]].add(edge)
+            self._incident_edges[edge[1]].add(edge)
+
+            for nonterminal in self._grammar.terminal_heads.get(label, ()):
+                self._support(nonterminal, edge[0], edge[1], 1, facts)
+
+        # Only the consequences of the new facts are derived
+        self._add_base_facts(facts)
+
+    def _drop_edge(self, edge: Tuple[int, int, Any], count: int, removed_facts):
+        start, finish, label = edge
+        for nonterminal in self._grammar.terminal_heads.get(label, ()):
+            self._support(nonterminal, start, finish, -count, removed_facts)
+
+        self._edges[edge] -= count
+        if self._edges[edge] == 0:
+            del self._edges[edge]
+            self._incident_edges[start].discard(edge)
+            self._incident_edges[finish].discard(edge)
+
+    def remove_edges(self, edges: Iterable[Tuple[Any, Any, Any]]):
+        removed_facts = defaultdict(lambda: ([], []))
+        for start, finish, label in edges:
+            if start not in self.node_id or finish not in self.node_id:
+                continue
+            edge = (self.node_id[start], self.node_id[finish], label)
+            if edge in self._edges:
+                self._drop_edge(edge, 1, removed_facts)
+        self._remove_base_facts(removed_facts)
+
+    def remove_vertices(self, nodes: Iterable[Any]):
+        removed_facts = defaultdict(lambda: ([], []))
+        removed_ids = [self.node_id.pop(node) for node in nodes if node in self.node_id]
+        for node_id in removed_ids:
+            for edge in list(self._incident_edges.pop(node_id, ())):
+                self._drop_edge(edge, self._edges[edge], removed_facts)
+        # The slots of removed nodes stay empty, a node added again gets a new one
+        self._epsilon_facts(removed_ids, -1, removed_facts)
+        self._remove_base_facts(removed_facts)
+
+    def _remove_base_facts(self, removed_facts):
+        removed = self._facts_matrices(removed_facts)
+        for nonterminal, matrix in removed.items():
+            self._base.discard(nonterminal, matrix)
+
+        # Over-delete everything that has a derivation through a removed fact
+        deleted = {
+            nonterminal: self._store[nonterminal].multiply(matrix).tocsr()
+            for nonterminal, matrix in removed.items()
+        }
+        delta = dict(deleted)
+        while delta:
+            derived = {}
+            for hd, nonterminal_1, nonterminal_2 in self._grammar.binary_productions:
+                if nonterminal_1 not in delta and nonterminal_2 not in delta:
+                    continue
+                product = self._store[nonterminal_1].dot(
+                    delta.get(nonterminal_2, self._store.default())
+                ) + delta.get(nonterminal_1, self._store.default()).dot(
+                    self._store[nonterminal_2]
+                )
+                derived[hd] = derived[hd] + product if hd in derived else product
+
+            delta = {}
+            for hd, product in derived.items():
+                candidates = self._store[hd].multiply(product).tocsr()
+                new_deleted = candidates > deleted[hd] if hd in deleted else candidates
+                if new_deleted.nnz != 0:
+                    delta[hd] = new_deleted
+                    deleted[hd] = (
+                        deleted[hd] + new_deleted if hd in deleted else new_deleted
+                    )
+
+        for nonterminal, matrix in deleted.items():
+            self._store.discard(nonterminal, matrix)
+
+        # Re-derive the deleted facts that still have a derivation in one step
+        # from what is left, and propagate them as new facts
+        rederived = {
+            nonterminal: self._base[nonterminal].multiply(matrix).tocsr()
+            for nonterminal, matrix in deleted.items()
+        }
+        for hd, nonterminal_1, nonterminal_2 in self._grammar.binary_productions:
+            if hd not in deleted:
+                continue
+            deleted_rows = scipy.sparse.diags(
+                deleted[hd].getnnz(axis=1) > 0, dtype=bool, format="csr"
+            )
+            product = (deleted_rows @ self._store[nonterminal_1]) @ self._store[
+                nonterminal_2
+            ]
+            rederived[hd] = rederived[hd] + deleted[hd].multiply(product).tocsr()
+        self._propagate(rederived)
+
+    def query(
+        self, start_nodes: Set[Any] = None, final_nodes: Set[Any] = None
+    ) -> set[tuple[Any, Any]]:
+        # Normalization drops a start symbol that derives no words
+        if self._grammar.start_id is None:
+            return set()
+
+        matrix = self._store[self._grammar.start_id]
+        return {
+            (self.nodes[i], self.nodes[j])
+            for i, j in zip(*matrix.nonzero())
+            if (start_nodes is None or self.nodes[i] in start_nodes)
+            and (final_nodes is None or self.nodes[j] in final_nodes)
+        }
+
+
 def matrix_based_cfpq(
     cfg: pyformlang.cfg.CFG,
     graph: nx.DiGraph,
     start_nodes: Set[int] = None,
     final_nodes: Set[int] = None,
+    semi_naive: bool = True,
+    restrict_to_sources: bool = True,
 ) -> set[tuple[int, int]]:
-    result = _matrix_based_cfpq(cfg, graph)
+    if restrict_to_sources:
+        graph = relevant_subgraph(graph, start_nodes, final_nodes)
+    result = _matrix_based_cfpq(cfg, graph, semi_naive)
     return {
         (n, m)
         for (n, nonterminal, m) in result
-        if nonterminal == cfg.start_symbol and n in start_nodes and m in final_nodes
+        if nonterminal == cfg.start_symbol
+        and (start_nodes is None or n in start_nodes)
+        and (final_nodes is None or m in final_nodes)
     }
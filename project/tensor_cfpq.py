@@ -1,10 +1,14 @@
 import networkx as nx
+import numpy as np
 
-from scipy.sparse import csc_array
+from collections import defaultdict
+from dataclasses import dataclass
+from pathlib import Path
+from scipy.sparse import csr_matrix, eye, kron
 from pyformlang import rsa, cfg as pycfg
-from pyformlang.finite_automaton import NondeterministicFiniteAutomaton
-from project.adjacency_matrix_fa import AdjacencyMatrixFA, intersect_automata
-from project.finite_automata_lib import graph_to_nfa
+from project.adjacency_matrix_fa import AdjacencyMatrixFA, bool_matrix_from_indices
+from project.graph_lib import relevant_subgraph
+from project.transitive_closure import extend_closure, transitive_closure
 from typing import Set, Tuple
 
 
@@ -17,79 +21,243 @@ def ebnf_to_rsm(ebnf: str) -> rsa.RecursiveAutomaton:
 
 
 def bool_decomposed_rsm(rsm: rsa.RecursiveAutomaton) -> AdjacencyMatrixFA:
-    nfa_of_rsm = NondeterministicFiniteAutomaton()
+    compiled_rsm = CompiledRSM.from_rsm(rsm)
+    decomposed_rsm = AdjacencyMatrixFA(None)
 
-    for nonterminal, box in rsm.boxes.items():
-        box_dfa = box.dfa
+    # States are the integer ids of the compiled RSM
+    decomposed_rsm.states_count = compiled_rsm.states_count
+    decomposed_rsm.id_state = {
+        state: state for state in range(compiled_rsm.states_count)
+    }
+    decomposed_rsm.state_id = dict(decomposed_rsm.id_state)
+    for starts in compiled_rsm.box_starts.values():
+        decomposed_rsm.start_states_id.update(starts.tolist())
+    for finals in compiled_rsm.box_finals.values():
+        decomposed_rsm.final_states_id.update(finals.tolist())
+    decomposed_rsm.start_states = set(decomposed_rsm.start_states_id)
+    decomposed_rsm.final_states = set(decomposed_rsm.final_states_id)
+    decomposed_rsm.bool_decomposition = dict(compiled_rsm.bool_decomposition)
+    return decomposed_rsm
+
+
+@dataclass
+class CompiledRSM:
+    initial_label: str
+    states_count: int
+    box_starts: dict[str, np.ndarray]
+    box_finals: dict[str, np.ndarray]
+    bool_decomposition: dict[str, csr_matrix]
+
+    @classmethod
+    def from_rsm(cls, rsm: rsa.RecursiveAutomaton) -> "CompiledRSM":
+        box_starts = {}
+        box_finals = {}
+        transitions = defaultdict(lambda: ([], []))
+        states_count = 0
 
-        for s in box_dfa.final_states | box_dfa.start_states:
-            if s in box_dfa.final_states:
-                nfa_of_rsm.add_final_state((nonterminal, s))
-            if s in box_dfa.start_states:
-                nfa_of_rsm.add_start_state((nonterminal, s))
+        for label, box in rsm.boxes.items():
+            box_dfa = box.dfa
+            state_id = {
+                state: states_count + index
+                for index, state in enumerate(box_dfa.states)
+            }
+            states_count += len(state_id)
 
-        for edge in box_dfa.to_networkx().edges(data="label"):
-            nfa_of_rsm.add_transition(
-                (nonterminal, edge[0]), edge[2], (nonterminal, edge[1])
+            box_starts[_label_value(label)] = np.array(
+                sorted(state_id[state] for state in box_dfa.start_states),
+                dtype=np.int64,
             )
+            box_finals[_label_value(label)] = np.array(
+                sorted(state_id[state] for state in box_dfa.final_states),
+                dtype=np.int64,
+            )
+            for state, state_transitions in box_dfa.to_dict().items():
+                for symbol, next_state in state_transitions.items():
+                    rows, cols = transitions[_label_value(symbol)]
+                    rows.append(state_id[state])
+                    cols.append(state_id[next_state])
+
+        return cls(
+            initial_label=_label_value(rsm.initial_label),
+            states_count=states_count,
+            box_starts=box_starts,
+            box_finals=box_finals,
+            bool_decomposition={
+                symbol: bool_matrix_from_indices(rows, cols, states_count)
+                for symbol, (rows, cols) in transitions.items()
+            },
+        )
+
+    def save(self, path: str | Path) -> None:
+        boxes = list(self.box_starts)
+        symbols = list(self.bool_decomposition)
+        arrays = {
+            "initial_label": np.array(self.initial_label),
+            "states_count": np.array(self.states_count),
+            "boxes": np.array(boxes, dtype=str),
+            "symbols": np.array(symbols, dtype=str),
+        }
+        for index, box in enumerate(boxes):
+            arrays[f"box_starts_{index}"] = self.box_starts[box]
+            arrays[f"box_finals_{index}"] = self.box_finals[box]
+        for index, symbol in enumerate(symbols):
+            matrix = self.bool_decomposition[symbol]
+            arrays[f"indptr_{index}"] = matrix.indptr
+            arrays[f"indices_{index}"] = matrix.indices
+        np.savez(_npz_path(path), **arrays)
+
+    @classmethod
+    def load(cls, path: str | Path) -> "CompiledRSM":
+        with np.load(_npz_path(path), allow_pickle=False) as arrays:
+            states_count = int(arrays["states_count"])
+            boxes = [str(box) for box in arrays["boxes"]]
+            symbols = [str(symbol) for symbol in arrays["symbols"]]
+            return cls(
+                initial_label=str(arrays["initial_label"]),
+                states_count=states_count,
+                box_starts={
+                    box: arrays[f"box_starts_{index}"]
+                    for index, box in enumerate(boxes)
+                },
+                box_finals={
+                    box: arrays[f"box_finals_{index}"]
+                    for index, box in enumerate(boxes)
+                },
+                bool_decomposition={
+                    symbol: csr_matrix(
+                        (
+                            np.ones(len(arrays[f"indices_{index}"]), dtype=bool),
+                            arrays[f"indices_{index}"],
+                            arrays[f"indptr_{index}"],
+                        ),
+                        shape=(states_count, states_count),
+                        dtype=bool,
+                    )
+                    for index, symbol in enumerate(symbols)
+                },
+            )
+
+
+def _label_value(symbol) -> str:
+    # Labels are stored as strings, other values would not match graph labels
+    # after a save and load round trip
+    if not isinstance(symbol.value, str):
+        raise ValueError(f"RSM label {symbol.value!r} is not a string")
+    return symbol.value
+
+
+def _npz_path(path: str | Path) -> Path:
+    # np.savez appends the suffix itself, np.load does not
+    path = Path(path)
+    return path if path.suffix == ".npz" else path.with_name(path.name + ".npz")
+
+
+def _box_selectors(compiled_rsm: CompiledRSM, graph_states_count: int) -> dict:
+    # For every box, S and F such that S · M · F ORs the graph blocks of M
+    # between start and final states of the box in the product
+    graph_identity = eye(graph_states_count, dtype=bool, format="csr")
+    return {
+        box: (
+            kron(
+                _indicator(starts, compiled_rsm.states_count).T,
+                graph_identity,
+                "csr",
+            ),
+            kron(
+                _indicator(compiled_rsm.box_finals[box], compiled_rsm.states_count),
+                graph_identity,
+                "csr",
+            ),
+        )
+        for box, starts in compiled_rsm.box_starts.items()
+        if len(starts) != 0 and len(compiled_rsm.box_finals[box]) != 0
+    }
 
-    return AdjacencyMatrixFA(nfa_of_rsm)
+
+def _indicator(indices: np.ndarray, size: int) -> csr_matrix:
+    return csr_matrix(
+        (np.ones(len(indices), dtype=bool), (indices, np.zeros(len(indices)))),
+        shape=(size, 1),
+        dtype=bool,
+    )
+
+
+def _query_nodes(graph: nx.DiGraph, nodes: Set[int] | None, flag: str) -> Set | None:
+    # An empty set stands for all nodes, so that side is left unrestricted
+    if not nodes:
+        return None
+    return set(nodes) | {node for node, marked in graph.nodes(flag) if marked}
 
 
 def tensor_based_cfpq(
-    rsm: rsa.RecursiveAutomaton,
+    rsm: rsa.RecursiveAutomaton | CompiledRSM,
     graph: nx.DiGraph,
     start_nodes: Set[int] | None = None,
     final_nodes: Set[int] | None = None,
+    restrict_to_sources: bool = True,
 ) -> Set[Tuple[int, int]]:
-    decomposed_rsa = bool_decomposed_rsm(rsm)
-    decomposed_graph = AdjacencyMatrixFA(graph_to_nfa(graph, start_nodes, final_nodes))
-
-    for nonterminal in rsm.boxes:
-        for matrix in (decomposed_graph, decomposed_rsa):
-            if nonterminal not in matrix.bool_decomposition:
-                matrix.bool_decomposition[nonterminal] = csc_array(
-                    (matrix.states_count, matrix.states_count), dtype=bool
-                )
-
-    last_nonzero_number = 0
-    current_nonzero_number = None
-
-    while last_nonzero_number != current_nonzero_number:
-        last_nonzero_number = current_nonzero_number
-        intersection = intersect_automata(decomposed_rsa, decomposed_graph)
+    if restrict_to_sources:
+        graph = relevant_subgraph(
+            graph,
+            _query_nodes(graph, start_nodes, "is_start"),
+            _query_nodes(graph, final_nodes, "is_final"),
+        )
 
-        transitive_closure = intersection.get_transitive_closure()
+    compiled_rsm = rsm if isinstance(rsm, CompiledRSM) else CompiledRSM.from_rsm(rsm)
+    decomposed_graph = AdjacencyMatrixFA.from_graph(graph, start_nodes, final_nodes)
+    graph_states_count = decomposed_graph.states_count
 
-        for row_index, column_index in zip(*transitive_closure.nonzero()):
-            row_state = intersection.id_state[row_index]
-            column_state = intersection.id_state[column_index]
+    for box in compiled_rsm.box_starts:
+        if box not in decomposed_graph.bool_decomposition:
+            decomposed_graph.bool_decomposition[box] = csr_matrix(
+                (graph_states_count, graph_states_count), dtype=bool
+            )
 
-            (row_symbol, row_rsm_state), row_graph_state = row_state.value
-            (column_symbol, column_rsm_state), column_graph_state = column_state.value
+    box_selectors = _box_selectors(compiled_rsm, graph_states_count)
 
-            if (
-                row_symbol == column_symbol
-                and row_rsm_state in rsm.boxes[row_symbol].dfa.start_states
-                and column_rsm_state in rsm.boxes[row_symbol].dfa.final_states
-            ):
-                row_graph_index = decomposed_graph.state_id[row_graph_state]
-                column_graph_index = decomposed_graph.state_id[column_graph_state]
+    # The product is built once, later rounds only add nonterminal edges to it
+    product_states_count = compiled_rsm.states_count * graph_states_count
+    product = csr_matrix((product_states_count, product_states_count), dtype=bool)
+    for symbol in (
+        compiled_rsm.bool_decomposition.keys()
+        & decomposed_graph.bool_decomposition.keys()
+    ):
+        product += kron(
+            compiled_rsm.bool_decomposition[symbol],
+            decomposed_graph.bool_decomposition[symbol],
+            "csr",
+        )
+    closure = transitive_closure(product)
+    new_paths = closure
 
-                decomposed_graph.bool_decomposition[row_symbol][
-                    row_graph_index, column_graph_index
-                ] = True
+    while new_paths.nnz != 0:
+        added_edges = csr_matrix(product.shape, dtype=bool)
+        for symbol, (starts_selector, finals_selector) in box_selectors.items():
+            # Paths from a start to a final state of the box, OR'ed over all
+            # such pairs of box states
+            box_edges = starts_selector @ new_paths @ finals_selector
+            graph_matrix = decomposed_graph.bool_decomposition[symbol]
+            delta = box_edges > graph_matrix
+            if delta.nnz == 0:
+                continue
+            decomposed_graph.bool_decomposition[symbol] = graph_matrix + delta
+            if symbol in compiled_rsm.bool_decomposition:
+                added_edges += kron(
+                    compiled_rsm.bool_decomposition[symbol], delta, "csr"
+                )
 
-        current_nonzero_number = sum(
-            decomposed_graph.bool_decomposition[nonterminal].count_nonzero()
-            for nonterminal in decomposed_graph.bool_decomposition
-        )
+        if added_edges.nnz == 0:
+            break
+        extended_closure = extend_closure(closure, added_edges)
+        new_paths = extended_closure > closure
+        closure = extended_closure
 
+    # One slice of the initial label matrix instead of a lookup per pair
+    starts = np.array(sorted(decomposed_graph.start_states_id), dtype=np.int64)
+    finals = np.array(sorted(decomposed_graph.final_states_id), dtype=np.int64)
+    initial_matrix = decomposed_graph.bool_decomposition[compiled_rsm.initial_label]
+    rows, cols = initial_matrix[starts][:, finals].nonzero()
     return {
-        (n, m)
-        for n in decomposed_graph.start_states
-        for m in decomposed_graph.final_states
-        if decomposed_graph.bool_decomposition[rsm.initial_label][
-            decomposed_graph.state_id[n], decomposed_graph.state_id[m]
-        ]
+        (decomposed_graph.id_state[start_id], decomposed_graph.id_state[final_id])
+        for start_id, final_id in zip(starts[rows].tolist(), finals[cols].tolist())
     }
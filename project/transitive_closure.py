@@ -0,0 +1,133 @@
+import numpy as np
+
+from collections import deque
+from scipy.sparse import csr_matrix, eye
+from scipy.sparse.csgraph import connected_components
+
+# Condensing pays off once strongly connected components merge at least this
+# share of the states, the closure then gets dense even for sparse adjacency
+SCC_CONDENSATION_RATIO = 0.9
+
+CLOSURE_STRATEGIES = ("auto", "semi_naive", "scc")
+
+
+def semi_naive_closure(adjacency: csr_matrix) -> csr_matrix:
+    closure = csr_matrix(
+        adjacency + eye(adjacency.shape[0], dtype=bool, format="csr"), dtype=bool
+    )
+    delta = closure
+
+    while delta.nnz != 0:
+        # closure^2 = (old + delta)^2, and old^2 is already inside closure
+        squared = delta @ closure + closure @ delta
+        delta = squared > closure
+        closure = closure + delta
+
+    return closure
+
+
+def _topological_order(dag: csr_matrix) -> list[int]:
+    in_degree = np.diff(dag.tocsc().indptr)
+    queue = deque(np.flatnonzero(in_degree == 0).tolist())
+    order = []
+
+    while queue:
+        vertex = queue.popleft()
+        order.append(vertex)
+        for successor in dag.indices[dag.indptr[vertex] : dag.indptr[vertex + 1]]:
+            in_degree[successor] -= 1
+            if in_degree[successor] == 0:
+                queue.append(successor)
+
+    return order
+
+
+def _strong_components(adjacency: csr_matrix) -> tuple[int, np.ndarray]:
+    return connected_components(adjacency, directed=True, connection="strong")
+
+
+def scc_closure(
+    adjacency: csr_matrix, components: tuple[int, np.ndarray] | None = None
+) -> csr_matrix:
+    states_count = adjacency.shape[0]
+    components_count, component_of = (
+        _strong_components(adjacency) if components is None else components
+    )
+
+    membership = csr_matrix(
+        (
+            np.ones(states_count, dtype=bool),
+            (np.arange(states_count), component_of),
+        ),
+        shape=(states_count, components_count),
+        dtype=bool,
+    )
+    condensed = (membership.T @ adjacency @ membership).tocoo()
+    off_diagonal = condensed.row != condensed.col
+    dag = csr_matrix(
+        (
+            np.ones(np.count_nonzero(off_diagonal), dtype=bool),
+            (condensed.row[off_diagonal], condensed.col[off_diagonal]),
+        ),
+        shape=(components_count, components_count),
+        dtype=bool,
+    )
+
+    # Successors come later in topological order, so walk it backwards
+    reachable = [None] * components_count
+    for component in reversed(_topological_order(dag)):
+        successors = dag.indices[dag.indptr[component] : dag.indptr[component + 1]]
+        reachable[component] = np.unique(
+            np.concatenate(
+                [[component]] + [reachable[successor] for successor in successors]
+            )
+        ).astype(np.int64)
+
+    reachable_counts = [len(components) for components in reachable]
+    condensed_closure = csr_matrix(
+        (
+            np.ones(sum(reachable_counts), dtype=bool),
+            np.concatenate([[]] + reachable).astype(np.int64),
+            np.concatenate([[0], np.cumsum(reachable_counts)]),
+        ),
+        shape=(components_count, components_count),
+        dtype=bool,
+    )
+
+    return csr_matrix(membership @ condensed_closure @ membership.T, dtype=bool)
+
+
+def transitive_closure(adjacency: csr_matrix, strategy: str = "auto") -> csr_matrix:
+    if strategy not in CLOSURE_STRATEGIES:
+        raise ValueError(
+            f"Unknown closure strategy {strategy!r}, expected one of {CLOSURE_STRATEGIES}"
+        )
+
+    adjacency = csr_matrix(adjacency, dtype=bool)
+    states_count = adjacency.shape[0]
+    if states_count == 0:
+        return adjacency
+
+    if strategy == "auto":
+        # Linear in the size of the matrix, and reused by scc_closure
+        components = _strong_components(adjacency)
+        if components[0] <= SCC_CONDENSATION_RATIO * states_count:
+            return scc_closure(adjacency, components)
+        strategy = "semi_naive"
+
+    if strategy == "scc":
+        return scc_closure(adjacency)
+    return semi_naive_closure(adjacency)
+
+
+def extend_closure(closure: csr_matrix, added_edges: csr_matrix) -> csr_matrix:
+    # Paths that use new edges are closure · added · closure, repeated for
+    # paths that use several of them
+    closure = csr_matrix(closure, dtype=bool)
+    added_edges = csr_matrix(added_edges, dtype=bool)
+
+    while True:
+        extended = closure + (closure @ added_edges) @ closure
+        if extended.nnz == closure.nnz:
+            return closure
+        closure = extended
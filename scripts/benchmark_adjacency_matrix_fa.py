@@ -0,0 +1,51 @@
+import argparse
+import sys
+import time
+
+import shared
+
+sys.path.append(str(shared.ROOT))
+
+from project.adjacency_matrix_fa import AdjacencyMatrixFA  # noqa: E402
+from project.finite_automata_lib import graph_to_nfa  # noqa: E402
+from project.graph_lib import get_graph_by_name  # noqa: E402
+
+GRAPHS = ["skos", "travel", "univ", "atom", "pizza", "bzip", "pr", "ls"]
+
+
+def measure(build, repeats: int) -> float:
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        build()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare AdjacencyMatrixFA construction paths on cfpq_data graphs"
+    )
+    parser.add_argument("graphs", nargs="*", default=GRAPHS)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    print(
+        f"{'graph':<16}{'nodes':>10}{'edges':>10}{'from nfa, s':>14}{'direct, s':>12}"
+    )
+    for graph_name in args.graphs:
+        graph = get_graph_by_name(graph_name)
+        through_nfa = measure(
+            lambda: AdjacencyMatrixFA(graph_to_nfa(graph, set(), set())), args.repeats
+        )
+        direct = measure(
+            lambda: AdjacencyMatrixFA.from_graph(graph, set(), set()), args.repeats
+        )
+        print(
+            f"{graph_name:<16}{graph.number_of_nodes():>10}"
+            f"{graph.number_of_edges():>10}{through_nfa:>14.3f}{direct:>12.3f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
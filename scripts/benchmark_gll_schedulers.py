@@ -0,0 +1,67 @@
+import argparse
+import sys
+import time
+
+import cfpq_data
+import shared
+
+sys.path.append(str(shared.ROOT))
+sys.path.append(str(shared.TESTS / "autotests"))
+
+from constants import LABELS  # noqa: E402
+from grammars_constants import GRAMMARS_DIFFERENT  # noqa: E402
+from project.gll_cfpq import SCHEDULERS, GLLParser  # noqa: E402
+from project.tensor_cfpq import CompiledRSM, cfg_to_rsm  # noqa: E402
+
+
+def generate_graphs(sizes: list[int], seed: int) -> list:
+    return [
+        (
+            f"scale-free {size}",
+            cfpq_data.labeled_scale_free_graph(size, labels=LABELS, seed=seed),
+        )
+        for size in sizes
+    ] + [
+        (
+            f"binomial {size}",
+            cfpq_data.labeled_binomial_graph(size, 0.4, labels=LABELS, seed=seed),
+        )
+        for size in sizes
+    ]
+
+
+def run(rsm: CompiledRSM, graph, scheduler: str) -> tuple[float, set]:
+    start = time.perf_counter()
+    result = GLLParser(rsm, graph, scheduler).query()
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare GLL descriptor schedulers on the task 9 grammars"
+    )
+    parser.add_argument("--sizes", type=int, nargs="*", default=[40, 100, 200])
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    rsms = [CompiledRSM.from_rsm(cfg_to_rsm(cfg)) for cfg in GRAMMARS_DIFFERENT]
+
+    print(f"{'graph':<18}" + "".join(f"{name + ', s':>12}" for name in SCHEDULERS))
+    for graph_name, graph in generate_graphs(args.sizes, args.seed):
+        total_times = dict.fromkeys(SCHEDULERS, 0.0)
+        for rsm in rsms:
+            results = []
+            for scheduler in SCHEDULERS:
+                elapsed, result = run(rsm, graph, scheduler)
+                total_times[scheduler] += elapsed
+                results.append(result)
+            assert all(result == results[0] for result in results)
+
+        print(
+            f"{graph_name:<18}"
+            + "".join(f"{total_times[name]:>12.3f}" for name in SCHEDULERS)
+        )
+
+
+if __name__ == "__main__":
+    main()
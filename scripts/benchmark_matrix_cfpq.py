@@ -0,0 +1,62 @@
+import argparse
+import sys
+import time
+
+import cfpq_data
+import shared
+
+sys.path.append(str(shared.ROOT))
+
+from project.graph_lib import get_graph_by_name  # noqa: E402
+from project.matrix_cfpq import _matrix_based_cfpq  # noqa: E402
+
+JAVA_GRAPHS = ["avrora", "batik", "luindex", "lusearch", "sunflow"]
+RDF_GRAPHS = ["skos", "travel", "univ", "atom", "generations", "pizza", "core"]
+
+# Same-generation query over the class hierarchy of RDF graphs
+RDF_GRAMMAR = """S -> subClassOf_r S subClassOf | type_r S type
+                 S -> subClassOf_r subClassOf | type_r type"""
+
+
+def load_query(graph_name: str):
+    graph = get_graph_by_name(graph_name)
+    if graph_name in JAVA_GRAPHS:
+        return graph, cfpq_data.java_points_to_grammar_from_graph(graph)
+    return cfpq_data.add_reverse_edges(graph), cfpq_data.cfg_from_text(RDF_GRAMMAR)
+
+
+def run(cfg, graph, semi_naive: bool) -> tuple[float, int, set]:
+    stats = {}
+    start = time.perf_counter()
+    result = _matrix_based_cfpq(cfg, graph, semi_naive, stats)
+    return time.perf_counter() - start, stats["rounds"], result
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare naive and semi-naive matrix CFPQ on cfpq_data graphs"
+    )
+    parser.add_argument("graphs", nargs="*", default=JAVA_GRAPHS + RDF_GRAPHS)
+    args = parser.parse_args()
+
+    print(
+        f"{'graph':<14}{'edges':>10}{'naive rounds':>14}{'naive, s':>10}"
+        f"{'semi-naive rounds':>19}{'semi-naive, s':>15}"
+    )
+    for graph_name in args.graphs:
+        graph, cfg = load_query(graph_name)
+        naive_time, naive_rounds, naive_result = run(cfg, graph, semi_naive=False)
+        semi_naive_time, semi_naive_rounds, semi_naive_result = run(
+            cfg, graph, semi_naive=True
+        )
+        assert naive_result == semi_naive_result
+
+        print(
+            f"{graph_name:<14}{graph.number_of_edges():>10}"
+            f"{naive_rounds:>14}{naive_time:>10.3f}"
+            f"{semi_naive_rounds:>19}{semi_naive_time:>15.3f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
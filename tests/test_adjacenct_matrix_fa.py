@@ -1,5 +1,7 @@
 from project import adjacency_matrix_fa as adj_m
+from project.finite_automata_lib import graph_to_nfa, regex_to_dfa
 from pyformlang.finite_automaton import DeterministicFiniteAutomaton
+from cfpq_data import labeled_two_cycles_graph
 
 
 def test_is_empty():
@@ -18,6 +20,12 @@ def test_is_empty():
     test_fa.add_transition(5, "b", 3)
     adjacency_matrix = adj_m.AdjacencyMatrixFA(test_fa)
     assert adjacency_matrix.is_empty()
+    assert adjacency_matrix.is_empty(bidirectional=True)
+
+    test_fa.add_transition(2, "c", 3)
+    adjacency_matrix = adj_m.AdjacencyMatrixFA(test_fa)
+    assert not adjacency_matrix.is_empty()
+    assert not adjacency_matrix.is_empty(bidirectional=True)
 
 
 def test_intersect_automata():
@@ -37,3 +45,75 @@ def test_intersect_automata():
     bool_matrix_for_a_elem = intersection.bool_decomposition["a"]
     assert bool_matrix_for_a_elem[0, 4]
     assert bool_matrix_for_a_elem[1, 5]
+
+
+def test_from_graph():
+    graph = labeled_two_cycles_graph(3, 4, labels=("a", "b"))
+    from_nfa = adj_m.AdjacencyMatrixFA(graph_to_nfa(graph, {0}, set()))
+    from_graph = adj_m.AdjacencyMatrixFA.from_graph(graph, {0}, set())
+
+    assert from_graph.start_states == from_nfa.start_states
+    assert from_graph.final_states == from_nfa.final_states
+    assert from_graph.bool_decomposition.keys() == from_nfa.bool_decomposition.keys()
+    for label, matrix in from_graph.bool_decomposition.items():
+        expected_matrix = from_nfa.bool_decomposition[label]
+        assert {
+            (from_graph.id_state[i], from_graph.id_state[j])
+            for i, j in zip(*matrix.nonzero())
+        } == {
+            (from_nfa.id_state[i], from_nfa.id_state[j])
+            for i, j in zip(*expected_matrix.nonzero())
+        }
+
+
+def test_accepts_many():
+    dfa = regex_to_dfa("a* b | c c")
+    adjacency_matrix = adj_m.AdjacencyMatrixFA(dfa)
+    words = [[], ["b"], ["a", "a", "b"], ["c", "c"], ["c"], ["a", "b", "b"], ["d"]]
+
+    expected = [dfa.accepts(word) for word in words]
+    assert [adjacency_matrix.accepts(word) for word in words] == expected
+    assert adjacency_matrix.accepts_many(words) == expected
+
+
+def test_lazy_tensor_based_rpq():
+    graph = labeled_two_cycles_graph(3, 4, labels=("a", "b"))
+    start_nodes, final_nodes = {0, 1}, {0, 2, 5}
+
+    for regex in ["a*", "a b*", "(a|b)* b", "b b b"]:
+        assert adj_m.tensor_based_rpq(
+            regex, graph, start_nodes, final_nodes, lazy=True
+        ) == adj_m.tensor_based_rpq(regex, graph, start_nodes, final_nodes)
+
+
+def test_tensor_based_rpq_pairs():
+    graph = labeled_two_cycles_graph(3, 4, labels=("a", "b"))
+    expected = adj_m.tensor_based_rpq("a* b b", graph, {0, 1}, {5, 6})
+
+    assert expected == {(0, 5), (1, 5)}
+
+    pairs = adj_m.tensor_based_rpq_pairs("a* b b", graph, {0, 1}, {5, 6})
+    assert pairs.shape == (len(expected), 2)
+    assert {(start, final) for start, final in pairs.tolist()} == expected
+
+    result_matrix = adj_m.tensor_based_rpq_matrix("a* b b", graph, {0, 1}, {5, 6})
+    nodes = list(graph.nodes)
+    assert {(nodes[i], nodes[j]) for i, j in zip(*result_matrix.nonzero())} == expected
+
+
+def test_tensor_based_rpq_empty_start_or_final_nodes():
+    graph = labeled_two_cycles_graph(3, 4, labels=("a", "b"))
+
+    for lazy in [False, True]:
+        assert adj_m.tensor_based_rpq("a*", graph, set(), set(), lazy=lazy) == set()
+        assert adj_m.tensor_based_rpq("a*", graph, {0}, set(), lazy=lazy) == set()
+        assert adj_m.tensor_based_rpq("a*", graph, set(), {0}, lazy=lazy) == set()
+
+    for start_nodes, final_nodes in [(set(), set()), ({0}, set()), (set(), {0})]:
+        assert (
+            adj_m.tensor_based_rpq_matrix("a*", graph, start_nodes, final_nodes).nnz
+            == 0
+        )
+        assert adj_m.tensor_based_rpq_pairs(
+            "a*", graph, start_nodes, final_nodes
+        ).shape == (0, 2)
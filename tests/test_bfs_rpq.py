@@ -1,6 +1,15 @@
-from project.bfs_rpq import ms_bfs_based_rpq
+from project.adjacency_matrix_fa import AdjacencyMatrixFA, tensor_based_rpq
+from project.bfs_rpq import (
+    chunk_size_for_memory,
+    frontier_memory_bound,
+    init_frontier,
+    ms_bfs_based_rpq,
+)
+from project.finite_automata_lib import regex_to_dfa
+from cfpq_data import labeled_two_cycles_graph
 
 import networkx as nx
+import pytest
 
 
 def test_ms_bfs_based_rpq():
@@ -15,3 +24,62 @@ def test_ms_bfs_based_rpq():
         {0},
         {1, 2},
     ) == {(0, 1)}
+
+
+def test_ms_bfs_based_rpq_many_starts():
+    graph = labeled_two_cycles_graph(3, 4, labels=("a", "b"))
+    start_nodes, final_nodes = {0, 1, 2, 4}, set(graph.nodes)
+
+    for regex in ["a*", "a b*", "(a|b)* b", "b b b"]:
+        assert ms_bfs_based_rpq(
+            regex, graph, start_nodes, final_nodes
+        ) == tensor_based_rpq(regex, graph, start_nodes, final_nodes)
+
+
+def test_init_frontier():
+    graph_mat = AdjacencyMatrixFA.from_graph(
+        labeled_two_cycles_graph(3, 4, labels=("a", "b")), set(), set()
+    )
+    reg_mat = AdjacencyMatrixFA(regex_to_dfa("a b*"))
+    (reg_start,) = reg_mat.start_states_id
+
+    frontier = init_frontier(reg_mat, graph_mat, [2, 0, 5])
+
+    assert frontier.shape == (3 * reg_mat.states_count, graph_mat.states_count)
+    assert set(zip(*frontier.nonzero())) == {
+        (block * reg_mat.states_count + reg_start, start)
+        for block, start in enumerate([2, 0, 5])
+    }
+
+
+def test_ms_bfs_based_rpq_chunks():
+    graph = labeled_two_cycles_graph(3, 4, labels=("a", "b"))
+    expected = ms_bfs_based_rpq("a* b b*", graph, set(), set())
+
+    assert ms_bfs_based_rpq("a* b b*", graph, set(), set(), chunk_size=3) == expected
+    assert (
+        ms_bfs_based_rpq("a* b b*", graph, set(), set(), chunk_size=2, workers=2)
+        == expected
+    )
+
+    graph_mat = AdjacencyMatrixFA.from_graph(graph, set(), set())
+    reg_mat = AdjacencyMatrixFA(regex_to_dfa("a* b b*"))
+    memory_limit = 2 * frontier_memory_bound(graph_mat, reg_mat, 1)
+    assert chunk_size_for_memory(graph_mat, reg_mat, memory_limit) == 2
+    assert (
+        ms_bfs_based_rpq("a* b b*", graph, set(), set(), memory_limit=memory_limit)
+        == expected
+    )
+
+
+def test_ms_bfs_based_rpq_invalid_chunks():
+    graph = labeled_two_cycles_graph(3, 4, labels=("a", "b"))
+
+    for options in [
+        {"chunk_size": 0},
+        {"chunk_size": -1},
+        {"memory_limit": 1},
+        {"chunk_size": 2, "memory_limit": 10**9},
+    ]:
+        with pytest.raises(ValueError):
+            ms_bfs_based_rpq("a* b b*", graph, set(), set(), **options)
@@ -1,3 +1,4 @@
+import cfpq_data
 import pyformlang.cfg
 
 from project import cfpq_hellings
@@ -59,3 +60,32 @@ def test_cfg_to_weak_normal_form():
     )
     for production in not_generating_symbols_test_grammar.productions:
         assert production.head.value in reachable_symbols
+
+
+def test_compile_grammar():
+    grammar = cfpq_hellings.compile_grammar(
+        pyformlang.cfg.CFG.from_text("S -> a S b | $")
+    )
+
+    assert grammar is cfpq_hellings.compile_grammar(
+        pyformlang.cfg.CFG.from_text("S -> $ | a S b")
+    )
+    assert grammar.nonterminals[grammar.start_id] == pyformlang.cfg.Variable("S")
+    assert [grammar.nonterminals[head] for head in grammar.epsilon_heads] == [
+        pyformlang.cfg.Variable("S")
+    ]
+    assert grammar.terminal_heads.keys() == {"a", "b"}
+    assert len(grammar.binary_productions) == 2
+
+
+def test_hellings_based_cfpq_restricted_to_sources():
+    graph = cfpq_data.labeled_two_cycles_graph(3, 2, labels=("a", "b"))
+    graph.add_edge(3, 10, label="b")
+    grammar = pyformlang.cfg.CFG.from_text("S -> a S b | a b")
+
+    for start_nodes, final_nodes in [({0}, {0, 10}), ({1, 2}, None), (None, {10})]:
+        assert cfpq_hellings.hellings_based_cfpq(
+            grammar, graph, start_nodes, final_nodes
+        ) == cfpq_hellings.hellings_based_cfpq(
+            grammar, graph, start_nodes, final_nodes, restrict_to_sources=False
+        )
@@ -0,0 +1,122 @@
+import pytest
+import cfpq_data
+import pyformlang.cfg
+
+from project import gll_cfpq
+from project.cfpq_hellings import hellings_based_cfpq
+from project.tensor_cfpq import CompiledRSM, cfg_to_rsm
+
+
+def test_gll_based_cfpq():
+    graph = cfpq_data.labeled_two_cycles_graph(3, 2, labels=("a", "b"))
+    grammar = pyformlang.cfg.CFG.from_text("S -> a S b | a b")
+    nodes = set(graph.nodes)
+
+    expected = hellings_based_cfpq(grammar, graph, nodes, nodes)
+    assert gll_cfpq.gll_based_cfpq(cfg_to_rsm(grammar), graph, nodes, nodes) == expected
+    assert (
+        gll_cfpq.gll_based_cfpq(
+            CompiledRSM.from_rsm(cfg_to_rsm(grammar)), graph, nodes, nodes
+        )
+        == expected
+    )
+
+
+def test_gll_parser_descriptors_are_ints():
+    graph = cfpq_data.labeled_two_cycles_graph(2, 2, labels=("a", "b"))
+    parser = gll_cfpq.GLLParser(
+        cfg_to_rsm(pyformlang.cfg.CFG.from_text("S -> a S b | $")), graph
+    )
+    parser.query({0})
+
+    assert parser.added_descriptors
+    assert all(isinstance(descriptor, int) for descriptor in parser.added_descriptors)
+
+
+def test_gll_parser_label_edges():
+    graph = cfpq_data.labeled_two_cycles_graph(2, 2, labels=("a", "b"))
+    parser = gll_cfpq.GLLParser(
+        cfg_to_rsm(pyformlang.cfg.CFG.from_text("S -> a S b | $")), graph
+    )
+
+    for from_node, to_node, label in graph.edges(data="label"):
+        node = parser.node_id[from_node]
+        indptr, indices = parser.label_edges[label]
+        assert parser.node_id[to_node] in indices[indptr[node] : indptr[node + 1]]
+
+
+def test_gll_parser_reused_across_queries():
+    graph = cfpq_data.labeled_two_cycles_graph(3, 2, labels=("a", "b"))
+    grammar = pyformlang.cfg.CFG.from_text("S -> a S b | a b")
+    parser = gll_cfpq.GLLParser(cfg_to_rsm(grammar), graph)
+
+    for start_nodes, final_nodes in [({0}, None), ({1, 2}, {0}), ({0, 3}, {4, 5})]:
+        assert parser.query(start_nodes, final_nodes) == hellings_based_cfpq(
+            grammar, graph, start_nodes, final_nodes
+        )
+
+    gss_nodes_count = len(parser.gss_state)
+    parser.query({0})
+    assert len(parser.gss_state) == gss_nodes_count
+
+
+def test_gll_parser_iter_query():
+    graph = cfpq_data.labeled_two_cycles_graph(3, 2, labels=("a", "b"))
+    grammar = pyformlang.cfg.CFG.from_text("S -> a S b | a b")
+    nodes = set(graph.nodes)
+    expected = hellings_based_cfpq(grammar, graph, nodes, nodes)
+
+    parser = gll_cfpq.GLLParser(cfg_to_rsm(grammar), graph)
+    first_pairs = list(parser.iter_query(limit=1))
+    assert len(first_pairs) == 1 and first_pairs[0] in expected
+
+    assert list(parser.iter_query(limit=0)) == []
+    assert parser.query() == expected
+
+    pairs = list(gll_cfpq.GLLParser(cfg_to_rsm(grammar), graph).iter_query())
+    assert len(pairs) == len(expected) and set(pairs) == expected
+
+
+@pytest.mark.parametrize("scheduler", list(gll_cfpq.SCHEDULERS))
+def test_gll_schedulers(scheduler):
+    graph = cfpq_data.labeled_two_cycles_graph(3, 2, labels=("a", "b"))
+    grammar = pyformlang.cfg.CFG.from_text("S -> a S b | S S | $")
+    nodes = set(graph.nodes)
+
+    assert gll_cfpq.gll_based_cfpq(
+        cfg_to_rsm(grammar), graph, nodes, nodes, scheduler
+    ) == hellings_based_cfpq(grammar, graph, nodes, nodes)
+
+
+def test_grouped_scheduler_batches():
+    scheduler = gll_cfpq.NodeGroupedScheduler(4, 4)
+    for gss, state, node in [(1, 0, 2), (2, 0, 2), (3, 1, 2), (4, 0, 3)]:
+        scheduler.push(gss, state, node)
+
+    batches = [scheduler.pop_batch() for _ in range(3)]
+    assert len(scheduler) == 0
+    assert sorted(batches) == [(0, 2, [1, 2]), (0, 3, [4]), (1, 2, [3])]
+
+
+def test_incomplete_scheduler():
+    class NoLenScheduler(gll_cfpq.DescriptorScheduler):
+        def push(self, gss, state, node):
+            pass
+
+        def pop_batch(self):
+            pass
+
+    class NoSplitScheduler(gll_cfpq._GroupedScheduler):
+        def _join(self, outer, inner):
+            return outer, inner
+
+    for scheduler in [NoLenScheduler, NoSplitScheduler]:
+        with pytest.raises(TypeError):
+            scheduler(4, 4)
+
+
+def test_unknown_scheduler():
+    with pytest.raises(ValueError):
+        gll_cfpq.GLLParser(
+            cfg_to_rsm(pyformlang.cfg.CFG.from_text("S -> a")), None, "x"
+        )
@@ -1,5 +1,7 @@
 import os
 import filecmp
+import cfpq_data
+import networkx as nx
 from project import graph_lib
 
 os.chdir("./tests/")
@@ -42,3 +44,44 @@ def test_create_labeled_two_cycles_graph():
     )
     assert filecmp.cmp("test_files/expected_graph.dot", "test_graph.dot", shallow=False)
     os.remove("test_graph.dot")
+
+
+def test_graph_to_matrices():
+    graph = cfpq_data.labeled_two_cycles_graph(2, 3, labels=("a", "b"))
+    graph_matrices = graph_lib.graph_to_matrices(graph, {0}, set())
+
+    assert graph_matrices.nodes == list(graph.nodes)
+    assert graph_matrices.start_nodes_id == {graph_matrices.nodes.index(0)}
+    assert graph_matrices.final_nodes_id == set(range(len(graph_matrices.nodes)))
+    assert {
+        (graph_matrices.nodes[i], graph_matrices.nodes[j], label)
+        for label, matrix in graph_matrices.bool_decomposition.items()
+        for i, j in zip(*matrix.nonzero())
+    } == set(graph.edges(data="label"))
+
+
+def test_csv_to_matrices(tmp_path):
+    path = tmp_path / "graph.csv"
+    path.write_text("10 20 a\n20 30 b\n30 10 a\n")
+    graph_matrices = graph_lib.csv_to_matrices(path, {10, 40}, set())
+
+    assert graph_matrices.nodes == [10, 20, 30]
+    assert graph_matrices.start_nodes_id == {0}
+    assert graph_matrices.final_nodes_id == {0, 1, 2}
+    assert set(zip(*graph_matrices.bool_decomposition["a"].nonzero())) == {
+        (0, 1),
+        (2, 0),
+    }
+    assert set(zip(*graph_matrices.bool_decomposition["b"].nonzero())) == {(1, 2)}
+
+
+def test_relevant_subgraph():
+    graph = nx.MultiDiGraph()
+    graph.add_edges_from([(0, 1), (1, 2), (2, 0), (3, 1), (2, 4), (5, 6)], label="a")
+
+    assert set(graph_lib.relevant_subgraph(graph, {3}, {0}).nodes) == {0, 1, 2, 3}
+    assert set(graph_lib.relevant_subgraph(graph, {0}, {4}).nodes) == {0, 1, 2, 4}
+    assert set(graph_lib.relevant_subgraph(graph, {5}, None).nodes) == {5, 6}
+    assert set(graph_lib.relevant_subgraph(graph, None, {3}).nodes) == {3}
+    assert set(graph_lib.relevant_subgraph(graph, {4}, {0}).nodes) == set()
+    assert graph_lib.relevant_subgraph(graph) is graph
@@ -1,5 +1,7 @@
 import pyformlang.cfg
 import networkx as nx
+import cfpq_data
+import scipy
 
 from project import matrix_cfpq
 
@@ -43,3 +45,122 @@ def test_hellings_based_cfpq():
 
     assert cfpq_result_lecture_graph == {(3, 0), (3, 1)}
     assert cfpq_result_one_way_graph == {(0, 2)}
+
+
+def test_semi_naive_matrix_based_cfpq():
+    graph = cfpq_data.labeled_two_cycles_graph(3, 2, labels=("a", "b"))
+    grammar = pyformlang.cfg.CFG.from_text("S -> a S b | a b")
+    nodes = set(graph.nodes)
+
+    assert matrix_cfpq.matrix_based_cfpq(
+        grammar, graph, nodes, nodes, semi_naive=True
+    ) == matrix_cfpq.matrix_based_cfpq(grammar, graph, nodes, nodes, semi_naive=False)
+
+
+def test_nonterminal_matrix_store():
+    store = matrix_cfpq.NonterminalMatrixStore(3, 2)
+    update = scipy.sparse.csr_matrix([[True, False], [False, True]])
+
+    assert 0 not in store
+    assert store[0].nnz == 0 and 0 not in store
+
+    assert store.accumulate(0, update).nnz == 2
+    stored = store[0]
+    assert store.accumulate(0, update).nnz == 0
+    assert store[0] is stored
+
+    assert (
+        store.accumulate(0, scipy.sparse.csr_matrix([[True, True], [False, False]])).nnz
+        == 1
+    )
+    assert [nonterminal for nonterminal, _ in store.items()] == [0]
+    assert store.nnz() == 3
+
+
+def test_matrix_based_cfpq_restricted_to_sources():
+    graph = cfpq_data.labeled_two_cycles_graph(3, 2, labels=("a", "b"))
+    graph.add_edge(3, 10, label="b")
+    grammar = pyformlang.cfg.CFG.from_text("S -> a S b | a b")
+
+    for start_nodes, final_nodes in [({0}, {0, 10}), ({1, 2}, None), (None, {10})]:
+        assert matrix_cfpq.matrix_based_cfpq(
+            grammar, graph, start_nodes, final_nodes
+        ) == matrix_cfpq.matrix_based_cfpq(
+            grammar, graph, start_nodes, final_nodes, restrict_to_sources=False
+        )
+
+
+def test_incremental_matrix_cfpq():
+    graph = cfpq_data.labeled_two_cycles_graph(3, 2, labels=("a", "b"))
+    grammar = pyformlang.cfg.CFG.from_text("S -> a S b | a b")
+    edges = list(graph.edges(data="label"))
+
+    index = matrix_cfpq.IncrementalMatrixCFPQ(grammar)
+    partial_graph = nx.MultiDiGraph()
+    for batch_start in range(0, len(edges), 2):
+        batch = edges[batch_start : batch_start + 2]
+        index.add_edges(batch)
+        partial_graph.add_edges_from((u, v, {"label": label}) for u, v, label in batch)
+
+        nodes = set(partial_graph.nodes)
+        assert index.query() == matrix_cfpq.matrix_based_cfpq(
+            grammar, partial_graph, nodes, nodes
+        )
+
+    assert index.query({0}, {0}) == matrix_cfpq.matrix_based_cfpq(
+        grammar, graph, {0}, {0}
+    )
+
+
+def test_incremental_matrix_cfpq_new_nodes():
+    grammar = pyformlang.cfg.CFG.from_text("S -> a S | $")
+    index = matrix_cfpq.IncrementalMatrixCFPQ(grammar)
+
+    index.add_nodes([0])
+    assert index.query() == {(0, 0)}
+
+    index.add_edges([(1, 0, "a")])
+    assert index.query() == {(0, 0), (1, 1), (1, 0)}
+
+
+def test_incremental_matrix_cfpq_removals():
+    graph = cfpq_data.labeled_two_cycles_graph(3, 2, labels=("a", "b"))
+    grammar = pyformlang.cfg.CFG.from_text("S -> a S b | a b")
+    index = matrix_cfpq.IncrementalMatrixCFPQ(grammar, graph)
+
+    index.add_edges([(0, 1, "a")])
+    index.remove_edges([(0, 1, "a")])
+    nodes = set(graph.nodes)
+    assert index.query() == matrix_cfpq.matrix_based_cfpq(grammar, graph, nodes, nodes)
+
+    index.remove_edges([(0, 1, "a"), (4, 5, "b")])
+    graph.remove_edge(0, 1)
+    graph.remove_edge(4, 5)
+    assert index.query() == matrix_cfpq.matrix_based_cfpq(grammar, graph, nodes, nodes)
+
+    index.remove_vertices([2])
+    graph.remove_node(2)
+    nodes = set(graph.nodes)
+    assert index.query() == matrix_cfpq.matrix_based_cfpq(grammar, graph, nodes, nodes)
+
+
+def test_incremental_matrix_cfpq_removal_keeps_epsilon_facts():
+    grammar = pyformlang.cfg.CFG.from_text("S -> a S | $")
+    index = matrix_cfpq.IncrementalMatrixCFPQ(grammar)
+
+    index.add_edges([(0, 0, "a"), (1, 0, "a")])
+    index.remove_edges([(0, 0, "a")])
+    assert index.query() == {(0, 0), (1, 1), (1, 0)}
+
+    index.remove_vertices([0])
+    assert index.query() == {(1, 1)}
+
+
+def test_incremental_matrix_cfpq_without_start_symbol():
+    graph = cfpq_data.labeled_two_cycles_graph(3, 2, labels=("a", "b"))
+    grammar = pyformlang.cfg.CFG.from_text("S -> S a")
+    index = matrix_cfpq.IncrementalMatrixCFPQ(grammar, graph)
+
+    assert index.query() == set()
+    index.add_edges([(0, 1, "a")])
+    assert index.query() == set()
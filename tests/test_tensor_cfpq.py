@@ -0,0 +1,89 @@
+import pytest
+import cfpq_data
+import pyformlang.cfg
+from pyformlang import rsa
+from pyformlang.finite_automaton import DeterministicFiniteAutomaton
+
+from project import tensor_cfpq
+
+
+def test_compiled_rsm():
+    rsm = tensor_cfpq.ebnf_to_rsm("S -> a S b | $")
+    compiled_rsm = tensor_cfpq.CompiledRSM.from_rsm(rsm)
+
+    assert compiled_rsm.initial_label == "S"
+    assert compiled_rsm.states_count == len(rsm.boxes[rsm.initial_label].dfa.states)
+    assert compiled_rsm.bool_decomposition.keys() == {"a", "b", "S"}
+    assert len(compiled_rsm.box_starts["S"]) == 1
+    assert compiled_rsm.box_finals["S"].tolist() != []
+
+
+def test_bool_decomposed_rsm():
+    rsm = tensor_cfpq.ebnf_to_rsm("S -> a S b | $")
+    compiled_rsm = tensor_cfpq.CompiledRSM.from_rsm(rsm)
+    decomposed_rsm = tensor_cfpq.bool_decomposed_rsm(rsm)
+
+    assert decomposed_rsm.states_count == compiled_rsm.states_count
+    assert decomposed_rsm.start_states_id == set(compiled_rsm.box_starts["S"].tolist())
+    assert decomposed_rsm.final_states_id == set(compiled_rsm.box_finals["S"].tolist())
+    assert decomposed_rsm.bool_decomposition.keys() == {"a", "b", "S"}
+
+
+def test_compiled_rsm_save_and_load(tmp_path):
+    graph = cfpq_data.labeled_two_cycles_graph(3, 2, labels=("a", "b"))
+    rsm = tensor_cfpq.cfg_to_rsm(pyformlang.cfg.CFG.from_text("S -> a S b | a b"))
+    path = tmp_path / "rsm.npz"
+    tensor_cfpq.CompiledRSM.from_rsm(rsm).save(path)
+    compiled_rsm = tensor_cfpq.CompiledRSM.load(path)
+
+    nodes = set(graph.nodes)
+    assert tensor_cfpq.tensor_based_cfpq(
+        compiled_rsm, graph, nodes, nodes
+    ) == tensor_cfpq.tensor_based_cfpq(rsm, graph, nodes, nodes)
+    assert tensor_cfpq.tensor_based_cfpq(compiled_rsm, graph, nodes, nodes)
+
+
+def test_compiled_rsm_save_and_load_without_suffix(tmp_path):
+    rsm = tensor_cfpq.ebnf_to_rsm("S -> a S b | $")
+    path = tmp_path / "rsm"
+    tensor_cfpq.CompiledRSM.from_rsm(rsm).save(path)
+    compiled_rsm = tensor_cfpq.CompiledRSM.load(path)
+
+    assert (tmp_path / "rsm.npz").exists()
+    assert compiled_rsm.bool_decomposition.keys() == {"a", "b", "S"}
+
+
+def test_compiled_rsm_non_str_label():
+    dfa = DeterministicFiniteAutomaton()
+    dfa.add_transition(0, 1, 1)
+    dfa.add_start_state(0)
+    dfa.add_final_state(1)
+    rsm = rsa.RecursiveAutomaton(initial_label="S", boxes={rsa.Box(dfa, "S")})
+
+    with pytest.raises(ValueError):
+        tensor_cfpq.CompiledRSM.from_rsm(rsm)
+
+
+def test_tensor_based_cfpq_restricts_start_side_only(monkeypatch):
+    graph = cfpq_data.labeled_two_cycles_graph(3, 2, labels=("a", "b"))
+    unreachable = cfpq_data.labeled_two_cycles_graph(3, 2, labels=("a", "b"))
+    graph.add_edges_from(
+        (u + 100, v + 100, data) for u, v, data in unreachable.edges(data=True)
+    )
+    rsm = tensor_cfpq.cfg_to_rsm(pyformlang.cfg.CFG.from_text("S -> a S b | a b"))
+    expected = tensor_cfpq.tensor_based_cfpq(
+        rsm, graph, {0}, set(), restrict_to_sources=False
+    )
+
+    subgraphs = []
+    relevant_subgraph = tensor_cfpq.relevant_subgraph
+
+    def recording_subgraph(*args):
+        subgraphs.append(relevant_subgraph(*args))
+        return subgraphs[-1]
+
+    monkeypatch.setattr(tensor_cfpq, "relevant_subgraph", recording_subgraph)
+
+    assert tensor_cfpq.tensor_based_cfpq(rsm, graph, {0}, set()) == expected
+    assert expected
+    assert all(node < 100 for node in subgraphs[0].nodes)
@@ -0,0 +1,66 @@
+import pytest
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from project import transitive_closure as transitive_closure_module
+from project.transitive_closure import extend_closure, transitive_closure
+
+
+@pytest.mark.parametrize("strategy", ["auto", "semi_naive", "scc"])
+def test_transitive_closure(strategy):
+    # 0 -> 1 -> 2 -> 1, 3 is isolated
+    adjacency = csr_matrix(
+        (np.ones(3, dtype=bool), ([0, 1, 2], [1, 2, 1])), shape=(4, 4), dtype=bool
+    )
+    closure = transitive_closure(adjacency, strategy)
+
+    assert set(zip(*closure.nonzero())) == {
+        (0, 0),
+        (0, 1),
+        (0, 2),
+        (1, 1),
+        (1, 2),
+        (2, 1),
+        (2, 2),
+        (3, 3),
+    }
+
+
+def test_transitive_closure_of_empty_matrix():
+    assert transitive_closure(csr_matrix((0, 0), dtype=bool)).shape == (0, 0)
+
+
+def test_extend_closure():
+    # 0 -> 1 and 2 -> 3, then 1 -> 2 and 3 -> 0 are added
+    adjacency = csr_matrix(
+        (np.ones(2, dtype=bool), ([0, 2], [1, 3])), shape=(4, 4), dtype=bool
+    )
+    added_edges = csr_matrix(
+        (np.ones(2, dtype=bool), ([1, 3], [2, 0])), shape=(4, 4), dtype=bool
+    )
+
+    extended = extend_closure(transitive_closure(adjacency), added_edges)
+
+    assert (extended != transitive_closure(adjacency + added_edges)).nnz == 0
+    assert extended.nnz == 16
+
+
+def test_auto_strategy_condenses_giant_scc(monkeypatch):
+    # One cycle through all states, far below any density threshold
+    states_count = 2000
+    adjacency = csr_matrix(
+        (
+            np.ones(states_count, dtype=bool),
+            (np.arange(states_count), (np.arange(states_count) + 1) % states_count),
+        ),
+        shape=(states_count, states_count),
+        dtype=bool,
+    )
+
+    def fail(_):
+        raise AssertionError("semi_naive_closure must not be chosen")
+
+    monkeypatch.setattr(transitive_closure_module, "semi_naive_closure", fail)
+    closure = transitive_closure(adjacency)
+
+    assert closure.nnz == states_count * states_count